@@ -14,9 +14,8 @@ if not dsn:
     print("ERROR: DATABASE_URL not set in .env")
     exit(1)
 
-conn = psycopg.connect(dsn, sslmode="require")
-with conn.cursor() as cur:
-    cur.execute("TRUNCATE comments, highlights, lecture_notes, rooms RESTART IDENTITY CASCADE")
-conn.commit()
-conn.close()
+# One transaction: either every table is emptied or none are.
+with psycopg.connect(dsn, sslmode="require") as conn:
+    with conn.transaction():
+        conn.execute("TRUNCATE comments, highlights, lecture_notes, rooms RESTART IDENTITY CASCADE")
 print("Database cleared — all rows removed, sequences reset.")
@@ -1,16 +1,86 @@
+import io
 import os
-import json
+import gzip
+import hashlib
+import tempfile
+import time
 import re
-import base64
+import asyncio
 import logging
+import functools
+from collections import OrderedDict
 
-import requests
+import diskcache
+import httpx
+import jiter
+import orjson
+import pybase64
 
 logger = logging.getLogger(__name__)
 
 OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY")
 OPENROUTER_MODEL = os.getenv("OPENROUTER_MODEL", "anthropic/claude-sonnet-4")
 IMAGE_GEN_MODEL = "google/gemini-3-pro-image-preview"
+OPENROUTER_URL = "https://openrouter.ai/api/v1/chat/completions"
+
+# Longest edge (px) of the board photo sent to the vision models.  Board
+# text stays legible well below typical camera resolutions, and the
+# smaller JPEG cuts upload size, base64 work and image-token cost.
+MAX_IMAGE_EDGE = int(os.getenv("MAX_IMAGE_EDGE", "1280"))
+JPEG_QUALITY = int(os.getenv("JPEG_QUALITY", "80"))
+
+# Generated diagrams are cached on disk by (board photo, prompt context): the
+# same board is captured over and over, and image generation is the slowest
+# and most expensive call in the pipeline.
+DIAGRAM_CACHE_DIR = os.getenv(
+    "DIAGRAM_CACHE_DIR", os.path.join(tempfile.gettempdir(), "diagram_cache")
+)
+DIAGRAM_CACHE_SIZE_LIMIT = 2 << 30  # bytes
+
+# Cap on image-generation calls in flight at once (across all rooms) so a
+# board full of diagrams doesn't trip OpenRouter's rate limits.
+DIAGRAM_CONCURRENCY = int(os.getenv("DIAGRAM_CONCURRENCY", "5"))
+_diagram_slots = asyncio.Semaphore(DIAGRAM_CONCURRENCY)
+
+# Byte-identical captures (same frame re-sent, same prompt) reuse the previous
+# answer instead of calling the model again.  Only exact matches count: a
+# perceptual hash can't tell a newly written line from camera noise.  Entries
+# expire after RESULT_CACHE_TTL seconds; RESULT_CACHE_SIZE=0 (the default)
+# disables the cache.
+RESULT_CACHE_SIZE = int(os.getenv("RESULT_CACHE_SIZE", "0"))
+RESULT_CACHE_TTL = float(os.getenv("RESULT_CACHE_TTL", "60"))
+_result_cache: OrderedDict[tuple, tuple[float, tuple[list[dict], list[str]]]] = OrderedDict()
+
+# Shared async client (HTTP/2 + keep-alive) so successive OpenRouter calls
+# reuse one connection and never block the event loop while the model works.
+_http = httpx.AsyncClient(
+    http2=True,
+    timeout=180,
+    headers={"Authorization": f"Bearer {OPENROUTER_API_KEY}"},
+)
+
+
+async def aclose() -> None:
+    """Close the shared OpenRouter HTTP client (call on app shutdown)."""
+    await _http.aclose()
+
+
+# Gzip the request body (mostly base64 image data, which deflates well).
+# Off by default: OpenRouter doesn't document compressed uploads.
+GZIP_REQUESTS = os.getenv("OPENROUTER_GZIP_REQUESTS", "").lower() in ("1", "true", "yes")
+
+
+async def _post_openrouter(
+    payload: dict, timeout: float, headers: dict | None = None
+) -> httpx.Response:
+    """POST a chat-completions payload to OpenRouter on the shared client."""
+    body = orjson.dumps(payload)
+    request_headers = {"Content-Type": "application/json", **(headers or {})}
+    if GZIP_REQUESTS:
+        # Level 1 recovers most of the base64 overhead at a fraction of the CPU.
+        body = gzip.compress(body, compresslevel=1)
+        request_headers["Content-Encoding"] = "gzip"
+    return await _http.post(OPENROUTER_URL, content=body, headers=request_headers, timeout=timeout)
 
 PROMPT = r"""You are converting a photograph of a chalkboard/whiteboard into clean, well-typeset lecture notes that read like a continuous document (similar to LaTeX lecture notes).
 
@@ -62,6 +132,43 @@ Example:
 ]"""
 
 
+# Appended to PROMPT when the previous capture is sent alongside the current
+# one.  Both variants are built once here so each frame mode sends the same
+# string object as its cached prefix.
+_MULTIFRAME_SUFFIX = (
+    "\n\nMULTI-FRAME CONTEXT:\n"
+    "You are being given TWO images of the same board taken moments apart.\n"
+    "- IMAGE 1 (first) is a PREVIOUS capture of the board.\n"
+    "- IMAGE 2 (second) is the CURRENT/LATEST capture.\n\n"
+    "A person (the professor) may be blocking parts of the board in one or both frames.\n"
+    "RULES for multi-frame merging:\n"
+    "- Use the CLEAREST view of each section across both frames.\n"
+    "- If content is visible in the previous frame but blocked in the current frame, use the previous frame's version.\n"
+    "- If content is visible in the current frame but was blocked before, use the current frame.\n"
+    "- If content appears in BOTH frames, prefer the current frame (it may have updates).\n"
+    "- If content is blocked in BOTH frames, omit it entirely — do NOT guess.\n"
+    "- NEVER produce garbled or half-complete sections. If you cannot read something clearly in either frame, leave it out.\n"
+    "- For diagrams: if the diagram is partially blocked in the current frame but was clear in the previous frame, describe the diagram based on the previous frame."
+)
+_PROMPT_WITH_MULTIFRAME = PROMPT + _MULTIFRAME_SUFFIX
+
+
+# Static instructions for the diagram re-drawing call (see generate_diagram_image).
+DIAGRAM_PROMPT = """Generate a clean, professional diagram from the description below.
+
+A reference photo of a chalkboard is attached for spatial context ONLY. Do NOT copy, enhance, filter, or screenshot the photo. The output must be a NEWLY DRAWN illustration — not a modified version of the input photo and not a screenshot of anything.
+
+REQUIREMENTS:
+- Draw the diagram FROM SCRATCH as a clean digital illustration (like a textbook figure)
+- Pure white background with clean black lines — nothing else
+- Accurate geometry: correct shapes, curves, angles, and proportions
+- Include all labels, annotations, axis labels, and arrows described
+- Use clear, readable sans-serif fonts for all text/labels
+- The output image must contain ONLY the diagram itself — no surrounding elements of any kind
+- Do NOT include any equations, definitions, or handwritten text from the board
+- High resolution and high contrast"""
+
+
 # Known LaTeX commands that start with characters that double as JSON escapes
 # (b → \b backspace, f → \f formfeed, n → \n newline, r → \r return, t → \t tab)
 _LATEX_CMDS_BY_FIRST = {
@@ -73,96 +180,235 @@ _LATEX_CMDS_BY_FIRST = {
 }
 
 
+def _trie_pattern(words) -> str:
+    """Build a prefix-factored regex (a trie) matching any of `words`.
+
+    e.g. ["bar", "beta", "bf"] -> "b(?:ar|eta|f)", so the regex engine
+    branches on each character instead of retrying every word in turn.
+    """
+    trie: dict = {}
+    for word in words:
+        node = trie
+        for ch in word:
+            node = node.setdefault(ch, {})
+        node[""] = {}  # end-of-word marker
+
+    def build(node: dict) -> str:
+        alts = [re.escape(ch) + build(child) for ch, child in sorted(node.items()) if ch]
+        if not alts:
+            return ""
+        if len(alts) == 1 and "" not in node:
+            return alts[0]
+        group = "(?:" + "|".join(alts) + ")"
+        return group + "?" if "" in node else group
+
+    return build(trie)
+
+
+# Every command above as one anchored trie pattern.  A command only counts
+# when no further ASCII letter follows (TeX command names are ASCII letters
+# only), so e.g. \nu never matches the start of \number.
+_LATEX_CMD_PATTERN = (
+    "(?:"
+    + _trie_pattern(cmd for cmds in _LATEX_CMDS_BY_FIRST.values() for cmd in cmds)
+    + r")(?![A-Za-z])"
+)
+_LATEX_CMD_RE = re.compile(_LATEX_CMD_PATTERN)
+
+
 def _is_latex_command(text: str, pos: int) -> bool:
     """Check if text[pos:] starts with a known LaTeX command name.
 
     `pos` should point to the first character AFTER the backslash.
-    Returns True only if a full command word matches (next char is non-alpha or end-of-string).
+    Returns True only if a full command word matches (next char is not an
+    ASCII letter, or end-of-string).
     """
-    if pos >= len(text):
-        return False
-    candidates = _LATEX_CMDS_BY_FIRST.get(text[pos])
-    if not candidates:
-        return False
-    for cmd in candidates:
-        end = pos + len(cmd)
-        if text[pos:end] == cmd and (end >= len(text) or not text[end].isalpha()):
-            return True
-    return False
+    return _LATEX_CMD_RE.match(text, pos) is not None
+
+
+# Markdown code fence the model sometimes wraps its JSON answer in.
+_CODE_FENCE_RE = re.compile(r"```(?:json)?\s*\n?(.*?)```", re.DOTALL)
+
+# A JSON string token: opening quote, body, then the closing quote -- or the
+# end of the text (with an optional dangling backslash) if it was truncated.
+_JSON_STRING_RE = re.compile(r'"((?:[^"\\]|\\.)*)("|\\?\Z)', re.DOTALL)
+
+# One backslash escape inside a string body: \uXXXX or backslash + any char.
+_ESCAPE_RE = re.compile(r"\\(u[0-9a-fA-F]{4}|.)", re.DOTALL)
+
+
+# Any backslash fix_latex_json would rewrite: one that starts an escape (an
+# odd position in its run of backslashes) and is not followed by a valid JSON
+# escape -- counting \b \f \n \r \t only when they don't begin a LaTeX
+# command.  A dangling backslash at the end of the text also matches.
+_NEEDS_FIX_RE = re.compile(
+    r'(?<!\\)(?:\\\\)*\\(?![\\"/]|u[0-9a-fA-F]{4}|(?!' + _LATEX_CMD_PATTERN + r')[bfnrt])'
+)
+
+
+def _fix_escape(m: re.Match) -> str:
+    esc = m.group(1)
+    if len(esc) == 5 or esc in ('\\', '"', '/'):
+        return m.group(0)  # valid JSON escape – keep as-is
+    if esc in 'bfnrt' and not _is_latex_command(m.string, m.start(1)):
+        # Ambiguous: could be a JSON escape (\n, \t, …) or a LaTeX command
+        # (\frac, \nu, \theta, …).  Only a *known* command word is LaTeX.
+        return m.group(0)  # JSON escape – keep as-is
+    return '\\' + m.group(0)  # LaTeX / invalid – escape the backslash
+
+
+def _fix_string(m: re.Match) -> str:
+    body = _ESCAPE_RE.sub(_fix_escape, m.group(1))
+    closing = m.group(2)
+    if closing == '\\':
+        closing = '\\\\'  # dangling backslash at end of text
+    return '"' + body + closing
 
 
 def fix_latex_json(text: str) -> str:
-    """Fix LaTeX backslashes inside JSON strings that break JSON parsing."""
-    result = []
-    i = 0
-    in_string = False
-
-    while i < len(text):
-        ch = text[i]
-
-        if not in_string:
-            if ch == '"':
-                in_string = True
-            result.append(ch)
-            i += 1
-            continue
+    """Fix LaTeX backslashes inside JSON strings that break JSON parsing.
+
+    Both the string tokenizing and the escape scan run as compiled regex
+    sweeps; only the matched escapes reach Python code.  Well-formed answers
+    (the prompt asks for doubled backslashes) are detected with a single
+    search and returned unchanged without tokenizing.
+    """
+    if "\\" not in text or not _NEEDS_FIX_RE.search(text):
+        return text
+    return _JSON_STRING_RE.sub(_fix_string, text)
+
+
+def shrink_image(image_bytes: bytes, mime: str) -> tuple[bytes, str]:
+    """Downscale a board photo to MAX_IMAGE_EDGE and re-encode it as JPEG.
+
+    Images already within the limit are returned untouched unless they
+    carry an Exif rotation, which is applied so the model sees them
+    upright.  If the image can't be decoded the original bytes are
+    returned so the upload still goes through.
+
+    Returns:
+        (image_bytes, mime) of the image to send.
+    """
+    # Imported here so modules that only need the JSON / merge helpers
+    # don't pay for Pillow at import time.
+    from PIL import Image, ImageOps
+
+    try:
+        img = Image.open(io.BytesIO(image_bytes))
+        if max(img.size) <= MAX_IMAGE_EDGE and img.getexif().get(0x0112, 1) == 1:
+            return image_bytes, mime
+        # Apply any EXIF rotation first; the re-encoded JPEG drops the tag.
+        img = ImageOps.exif_transpose(img)
+        img.thumbnail((MAX_IMAGE_EDGE, MAX_IMAGE_EDGE), Image.LANCZOS)
+        buf = io.BytesIO()
+        img.convert("RGB").save(buf, "JPEG", quality=JPEG_QUALITY, optimize=True)
+    except Exception as e:
+        logger.warning(f"Could not downscale image, sending original: {e}")
+        return image_bytes, mime
+    logger.info("Downscaled image %d -> %d bytes", len(image_bytes), buf.tell())
+    return buf.getvalue(), "image/jpeg"
+
+
+def _is_section(item) -> bool:
+    """True if a parsed item has what upsert_notes needs to store it.
+
+    Its columns are bound as Postgres text, so values must be strings
+    (caption and image_url may be missing or null).
+    """
+    return (
+        isinstance(item, dict)
+        and isinstance(item.get("section_id"), str)
+        and isinstance(item.get("type"), str)
+        and isinstance(item.get("content"), str)
+        and isinstance(item.get("caption"), (str, type(None)))
+        and isinstance(item.get("image_url"), (str, type(None)))
+    )
+
+
+@functools.lru_cache(maxsize=64)
+def _parse_sections(text: str) -> tuple[dict, ...]:
+    """Fix LaTeX escapes in the model's JSON answer, parse and validate it.
+
+    Memoized on the raw answer text: a stable board often yields the exact
+    same answer on consecutive captures, so the fix-up + parse is skipped.
+    Returns a tuple (hashable, shared) — copy the dicts before mutating.
+
+    A truncated answer (the model hit its output limit) is parsed in jiter's
+    partial mode instead of being thrown away.  Either way, items without a
+    string section_id/type/content are dropped here rather than
+    failing later in the DB write; the cut-off section of a truncated
+    answer is dropped the same way.
+    """
+    text = fix_latex_json(text)
+    error = None
+    try:
+        parsed = orjson.loads(text)
+    except orjson.JSONDecodeError as e:
+        try:
+            parsed = jiter.from_json(text.encode(), partial_mode=True)
+        except ValueError:
+            raise e from None
+        error = e
+    if not isinstance(parsed, list):
+        raise error or ValueError(f"AI response is not a JSON array: {text[:100]}")
+
+    sections = tuple(item for item in parsed if _is_section(item))
+    if error is not None:
+        logger.warning(
+            f"AI response was not valid JSON ({error}); salvaged "
+            f"{len(sections)} of {len(parsed)} sections"
+        )
+    elif len(sections) != len(parsed):
+        logger.warning(f"Dropped {len(parsed) - len(sections)} malformed sections from AI response")
+    return sections
+
+
+def _capture_digests(image: bytes, previous_image: bytes | None) -> tuple[str, str | None]:
+    """Exact digests of the current (and previous) capture for the result cache."""
+    current = hashlib.sha256(image).hexdigest()
+    if previous_image is None:
+        return current, None
+    return current, hashlib.sha256(previous_image).hexdigest()
+
+
+def _copy_result(result: tuple[list[dict], list[str]]) -> tuple[list[dict], list[str]]:
+    """Copy a cached result, without generated diagram bytes.
+
+    A hit stands for an unchanged board, so its diagrams are already stored:
+    with no '_image_bytes' the caller keeps each section's existing image_url.
+    """
+    sections, consumed_ids = result
+    sections = [
+        {k: v for k, v in s.items() if k not in ("_image_bytes", "_image_ext")}
+        for s in sections
+    ]
+    return sections, list(consumed_ids)
 
-        # Inside a JSON string
-        if ch == '\\':
-            if i + 1 >= len(text):
-                result.append('\\\\')
-                i += 1
-                continue
-
-            next_ch = text[i + 1]
-
-            if next_ch == '\\':
-                result.append('\\\\')
-                i += 2
-            elif next_ch == '"':
-                result.append('\\"')
-                i += 2
-            elif next_ch == '/':
-                result.append('\\/')
-                i += 2
-            elif next_ch == 'u' and i + 5 < len(text) and all(
-                c in '0123456789abcdefABCDEF' for c in text[i + 2 : i + 6]
-            ):
-                result.append(text[i : i + 6])
-                i += 6
-            elif next_ch in 'bfnrt':
-                # Ambiguous: could be a JSON escape (\n, \t, …) or a LaTeX
-                # command (\frac, \nu, \theta, …).  Check whether the text
-                # starting at next_ch matches a *known* LaTeX command word.
-                if _is_latex_command(text, i + 1):
-                    result.append('\\\\')   # LaTeX – escape the backslash
-                    i += 1
-                else:
-                    result.append('\\')     # JSON escape – keep as-is
-                    i += 1
-            else:
-                result.append('\\\\')
-                i += 1
-        elif ch == '"':
-            in_string = False
-            result.append(ch)
-            i += 1
-        else:
-            result.append(ch)
-            i += 1
 
-    return ''.join(result)
+@functools.lru_cache(maxsize=1)
+def _diagram_cache() -> diskcache.Cache:
+    """Open the on-disk diagram cache (created on first use)."""
+    return diskcache.Cache(DIAGRAM_CACHE_DIR, size_limit=DIAGRAM_CACHE_SIZE_LIMIT)
 
 
-def generate_diagram_image(
-    chalkboard_image_path: str,
+def _diagram_cache_key(image_b64: str, diagram_context: str) -> str:
+    """Key a diagram by digests of the board photo and its prompt context."""
+    image_hash = hashlib.blake2b(image_b64.encode("ascii"), digest_size=8).hexdigest()
+    context_hash = hashlib.blake2b(diagram_context.encode(), digest_size=8).hexdigest()
+    return f"{image_hash}:{context_hash}"
+
+
+async def generate_diagram_image(
+    image_b64: str,
+    mime: str,
     diagram_description: str | None = None,
     all_sections: list[dict] | None = None,
 ) -> tuple[bytes, str] | None:
     """Enhance a diagram from the chalkboard image using OpenRouter.
 
     Args:
-        chalkboard_image_path: Path to the full chalkboard photo.
+        image_b64: Base64 encoding of the full chalkboard photo.
+        mime: MIME type of the photo.
         diagram_description: The text description of the diagram to focus on.
         all_sections: All sections extracted from this image (used to tell the
             model which text content to ignore / exclude from the diagram).
@@ -171,16 +417,21 @@ def generate_diagram_image(
         (image_bytes, extension) tuple, or None on failure.
     """
     logger.info("Enhancing diagram from chalkboard image...")
-    
-    with open(chalkboard_image_path, "rb") as f:
-        image_data = base64.b64encode(f.read()).decode("utf-8")
-    
-    ext = chalkboard_image_path.lower().rsplit(".", 1)[-1] if "." in chalkboard_image_path else "jpeg"
-    mime = {"jpg": "image/jpeg", "jpeg": "image/jpeg", "png": "image/png"}.get(ext, "image/jpeg")
 
-    # Build the list of text content to exclude from the generated image
-    exclude_block = ""
+    # Per-diagram context blocks, in prompt order, joined once at the end.
+    context_parts: list[str] = []
+    if diagram_description:
+        context_parts.append(f"DIAGRAM DESCRIPTION:\n{diagram_description}")
+
     if all_sections:
+        for s in all_sections:
+            if s.get("type") == "diagram" and s.get("content") == diagram_description:
+                cap = s.get("caption", "")
+                if cap:
+                    context_parts.append(f"CAPTION: {cap}")
+                break
+
+        # Text content to exclude from the generated image
         text_items = []
         for s in all_sections:
             if s.get("type") != "diagram":
@@ -188,8 +439,8 @@ def generate_diagram_image(
                 if preview:
                     text_items.append(f"  - {preview}")
         if text_items:
-            exclude_block = (
-                "\n\nIMPORTANT — TEXT TO EXCLUDE:\n"
+            context_parts.append(
+                "IMPORTANT — TEXT TO EXCLUDE:\n"
                 "The following text/equations also appear on the board but are "
                 "already captured as typed notes. Do NOT include any of this "
                 "text in the generated image. Only render the diagram/figure "
@@ -197,65 +448,49 @@ def generate_diagram_image(
                 + "\n".join(text_items)
             )
 
-    diagram_block = ""
-    if diagram_description:
-        diagram_block = (
-            f"\n\nDIAGRAM DESCRIPTION:\n{diagram_description}"
-        )
-
-    caption_block = ""
-    if all_sections:
-        for s in all_sections:
-            if s.get("type") == "diagram" and s.get("content") == diagram_description:
-                cap = s.get("caption", "")
-                if cap:
-                    caption_block = f"\n\nCAPTION: {cap}"
-                break
-
-    enhanced_prompt = f"""Generate a clean, professional diagram from the description below.
-
-A reference photo of a chalkboard is attached for spatial context ONLY. Do NOT copy, enhance, filter, or screenshot the photo. The output must be a NEWLY DRAWN illustration — not a modified version of the input photo and not a screenshot of anything.
-
-REQUIREMENTS:
-- Draw the diagram FROM SCRATCH as a clean digital illustration (like a textbook figure)
-- Pure white background with clean black lines — nothing else
-- Accurate geometry: correct shapes, curves, angles, and proportions
-- Include all labels, annotations, axis labels, and arrows described
-- Use clear, readable sans-serif fonts for all text/labels
-- The output image must contain ONLY the diagram itself — no surrounding elements of any kind
-- Do NOT include any equations, definitions, or handwritten text from the board
-- High resolution and high contrast{diagram_block}{caption_block}{exclude_block}"""
+    # The static instructions go first as a cacheable block; the per-diagram
+    # description / caption / exclusions follow uncached.
+    diagram_context = "\n\n".join(context_parts)
+    prompt_parts: list[dict] = [
+        {"type": "text", "text": DIAGRAM_PROMPT, "cache_control": {"type": "ephemeral"}},
+    ]
+    if diagram_context:
+        prompt_parts.append({"type": "text", "text": diagram_context})
     
     try:
-        resp = requests.post(
-            "https://openrouter.ai/api/v1/chat/completions",
-            headers={
-                "Authorization": f"Bearer {OPENROUTER_API_KEY}",
-                "Content-Type": "application/json",
-                "HTTP-Referer": "https://github.com/qhacks",
-                "X-Title": "QHacks Chalkboard Notes",
-            },
-            json={
-                "model": IMAGE_GEN_MODEL,
-                "messages": [
-                    {
-                        "role": "user",
-                        "content": [
-                            {"type": "text", "text": enhanced_prompt},
-                            {"type": "image_url", "image_url": {"url": f"data:{mime};base64,{image_data}"}},
-                        ],
-                    }
-                ],
-                "modalities": ["image", "text"],
-                "image_config": {"aspect_ratio": "16:9", "image_size": "2K"},
-                "temperature": 0.4,
-            },
-            timeout=180,
-        )
+        cache_key = _diagram_cache_key(image_b64, diagram_context)
+        cached = await asyncio.to_thread(_diagram_cache().get, cache_key)
+        if cached is not None:
+            logger.info("Diagram cache hit (%s)", cache_key)
+            return cached
+
+        async with _diagram_slots:
+            resp = await _post_openrouter(
+                {
+                    "model": IMAGE_GEN_MODEL,
+                    "messages": [
+                        {
+                            "role": "user",
+                            "content": [
+                                *prompt_parts,
+                                {"type": "image_url", "image_url": {"url": f"data:{mime};base64,{image_b64}"}},
+                            ],
+                        }
+                    ],
+                    "modalities": ["image", "text"],
+                    "image_config": {"aspect_ratio": "16:9", "image_size": "2K"},
+                    "temperature": 0.4,
+                },
+                timeout=180,
+                headers={
+                    "HTTP-Referer": "https://github.com/qhacks",
+                    "X-Title": "QHacks Chalkboard Notes",
+                },
+            )
         resp.raise_for_status()
         
-        message = resp.json()["choices"][0]["message"]
-        logger.info(f"Image gen response keys: {message.keys()}")
+        message = orjson.loads(resp.content)["choices"][0]["message"]
+        logger.info("Image gen response keys: %s", message.keys())
         
         if "images" not in message or not message["images"]:
             logger.error(f"No images in response. Content: {message.get('content', '')[:300]}")
@@ -266,17 +501,20 @@ REQUIREMENTS:
             logger.error(f"Unexpected image URL format: {data_url[:100]}")
             return None
         
-        match = re.search(r'data:image/(png|jpeg|jpg);base64,([A-Za-z0-9+/=]+)', data_url)
-        if not match:
+        # "data:image/<ext>;base64,<payload>" -- split on the fixed marker
+        # rather than running a regex over the multi-MB payload.
+        header, _, payload = data_url.partition(";base64,")
+        img_ext = header[len("data:image/"):]
+        if not payload or img_ext not in ("png", "jpeg", "jpg"):
             logger.error(f"Could not parse data URL: {data_url[:100]}")
             return None
         
-        img_ext = match.group(1)
-        img_bytes = base64.b64decode(match.group(2))
-        logger.info(f"Decoded diagram image ({len(img_bytes)} bytes, {img_ext})")
+        img_bytes = pybase64.b64decode(payload)
+        logger.info("Decoded diagram image (%d bytes, %s)", len(img_bytes), img_ext)
+        await asyncio.to_thread(_diagram_cache().set, cache_key, (img_bytes, img_ext))
         return img_bytes, img_ext
         
-    except requests.exceptions.RequestException as e:
+    except httpx.HTTPError as e:
         logger.error(f"HTTP request failed for image generation: {e}")
         return None
     except Exception as e:
@@ -287,67 +525,49 @@ REQUIREMENTS:
 def _build_prompt(
     existing_sections: list[dict] | None = None,
     has_previous_image: bool = False,
-) -> str:
-    """Build the full prompt, injecting existing section summaries when available.
+) -> tuple[str, str]:
+    """Build the prompt, injecting existing section summaries when available.
+
+    The prompt is returned in two parts so the static part can be sent as a
+    separately cached content block (Anthropic prompt caching).
 
     Args:
         existing_sections: List of dicts with keys section_id, type, and
-            content_preview.  When None or empty the base prompt is returned.
+            content_preview.  When None or empty the context part is empty.
         has_previous_image: When True, the message will contain two images
             (previous capture first, current capture second).  Extra instructions
             are appended so the AI merges information from both frames.
-    """
-    base = PROMPT
 
+    Returns:
+        (prefix, context) — prefix is the invariant instructions for this
+        frame mode; context is the per-room existing-notes block (may be "").
+    """
     # Multi-frame occlusion handling
-    if has_previous_image:
-        base += (
-            "\n\nMULTI-FRAME CONTEXT:\n"
-            "You are being given TWO images of the same board taken moments apart.\n"
-            "- IMAGE 1 (first) is a PREVIOUS capture of the board.\n"
-            "- IMAGE 2 (second) is the CURRENT/LATEST capture.\n\n"
-            "A person (the professor) may be blocking parts of the board in one or both frames.\n"
-            "RULES for multi-frame merging:\n"
-            "- Use the CLEAREST view of each section across both frames.\n"
-            "- If content is visible in the previous frame but blocked in the current frame, use the previous frame's version.\n"
-            "- If content is visible in the current frame but was blocked before, use the current frame.\n"
-            "- If content appears in BOTH frames, prefer the current frame (it may have updates).\n"
-            "- If content is blocked in BOTH frames, omit it entirely — do NOT guess.\n"
-            "- NEVER produce garbled or half-complete sections. If you cannot read something clearly in either frame, leave it out.\n"
-            "- For diagrams: if the diagram is partially blocked in the current frame but was clear in the previous frame, describe the diagram based on the previous frame."
-        )
+    base = _PROMPT_WITH_MULTIFRAME if has_previous_image else PROMPT
 
     if not existing_sections:
-        return base
+        return base, ""
 
-    # Find the highest block/diag numbers so the AI knows where to continue
+    # One pass: find the highest block/diag numbers so the AI knows where to
+    # continue, and build a readable summary of each existing section so it
+    # can decide whether the current board content matches one of them.
     max_block = 0
     max_diag = 0
-    for sec in existing_sections:
-        sid = sec["section_id"]
-        if sid.startswith("block-"):
-            try:
-                max_block = max(max_block, int(sid.split("-", 1)[1]))
-            except ValueError:
-                pass
-        elif sid.startswith("diag-"):
-            try:
-                max_diag = max(max_diag, int(sid.split("-", 1)[1]))
-            except ValueError:
-                pass
-
-    # Build a readable summary of each existing section so the AI can
-    # decide whether the current board content matches one of them.
     section_lines = []
     for sec in existing_sections:
+        sid = sec["section_id"]
+        kind, _, num = sid.partition("-")
+        if num.isdecimal():
+            if kind == "block":
+                max_block = max(max_block, int(num))
+            elif kind == "diag":
+                max_diag = max(max_diag, int(num))
         preview = sec.get("content_preview", "")
-        section_lines.append(
-            f'  - {sec["section_id"]} (type={sec["type"]}): "{preview}"'
-        )
+        section_lines.append(f'  - {sid} (type={sec["type"]}): "{preview}"')
     sections_block = "\n".join(section_lines)
 
     context = (
-        f"\n\nIMPORTANT — EXISTING NOTES CONTEXT:\n"
+        f"IMPORTANT — EXISTING NOTES CONTEXT:\n"
         f"The following sections already exist for this lecture:\n{sections_block}\n\n"
         f"- If the board still shows the SAME content as an existing section, you MUST reuse that section_id so it updates in place.\n"
         f"- Only create a NEW section_id for content that is genuinely new and not covered by any existing section.\n"
@@ -357,7 +577,17 @@ def _build_prompt(
         f"- If a section's content is BLOCKED by a person in the current frame, "
         f"reuse the existing section_id with the SAME content (do NOT replace good content with partial/garbled content)."
     )
-    return base + context
+    return base, context
+
+
+# Leading display math ($$) in a section, after any whitespace.
+_DISPLAY_MATH_START_RE = re.compile(r"\s*\$\$")
+
+# Terminal punctuation that signals end of a thought
+_TERMINAL_PUNCT = frozenset((".", "!", "?", ":", ";", "—"))
+
+# Merged blocks keep the more "specific" type (equation > note > step)
+_TYPE_PRIORITY = {"equation": 3, "definition": 3, "step": 2, "note": 1}
 
 
 def _should_merge(prev: dict, curr: dict) -> bool:
@@ -373,10 +603,13 @@ def _should_merge(prev: dict, curr: dict) -> bool:
     if prev.get("type") == "diagram" or curr.get("type") == "diagram":
         return False
 
+    # Only the previous block is stripped (once); the current block is
+    # inspected in place, and the inline-math walk below moves an index
+    # instead of slicing copies.
     prev_content = (prev.get("content") or "").rstrip()
-    curr_content = (curr.get("content") or "").lstrip()
+    curr_content = curr.get("content") or ""
 
-    if not prev_content or not curr_content:
+    if not prev_content or not curr_content or curr_content.isspace():
         return False
 
     # If the previous block ends with display math ($$...$$), treat it as
@@ -386,23 +619,20 @@ def _should_merge(prev: dict, curr: dict) -> bool:
 
     # If the current block starts with display math, it's likely a new
     # standalone equation block — don't merge.
-    if curr_content.lstrip().startswith("$$"):
+    if _DISPLAY_MATH_START_RE.match(curr_content):
         return False
 
-    # Strip trailing inline $ to find the real last prose character.
-    check_prev = prev_content
-    if check_prev.endswith("$") and not check_prev.endswith("$$"):
+    # Skip a trailing inline $ to find the real last prose character.
+    end = len(prev_content)
+    if prev_content.endswith("$"):
         # Walk backwards past the inline math to find what's before it
         # e.g. "is $\sin(x)$" → check the character before the opening $
-        inner_start = check_prev.rfind("$", 0, len(check_prev) - 1)
-        if inner_start > 0:
-            check_prev = check_prev[:inner_start].rstrip()
-        else:
-            check_prev = check_prev[:-1].rstrip()
+        inner_start = prev_content.rfind("$", 0, end - 1)
+        end = inner_start if inner_start > 0 else end - 1
+        while end and prev_content[end - 1].isspace():
+            end -= 1
 
-    # Terminal punctuation that signals end of a thought
-    terminal_punct = {".", "!", "?", ":", ";", "—"}
-    ends_with_punct = bool(check_prev) and check_prev[-1] in terminal_punct
+    ends_with_punct = end > 0 and prev_content[end - 1] in _TERMINAL_PUNCT
 
     # Only merge when the previous block clearly trails off mid-sentence
     if not ends_with_punct:
@@ -411,13 +641,20 @@ def _should_merge(prev: dict, curr: dict) -> bool:
     return False
 
 
-def _merge_sections(sections: list[dict]) -> tuple[list[dict], list[str]]:
+def _merge_sections(
+    sections: list[dict], inplace: bool = False
+) -> tuple[list[dict], list[str]]:
     """Post-process sections to merge consecutive blocks that were split mid-sentence.
 
     Preserves original section_ids as much as possible. When blocks are merged,
     the surviving block keeps the FIRST (earliest) section_id so existing DB
     rows are updated in-place rather than orphaned.
 
+    Args:
+        sections: Sections in board order.
+        inplace: Merge into the given dicts instead of copies; pass True
+            when the caller owns the dicts and won't reuse the input.
+
     Returns:
         (merged_sections, consumed_ids) — consumed_ids is the list of
         section_ids that were folded into another block and should be
@@ -430,7 +667,7 @@ def _merge_sections(sections: list[dict]) -> tuple[list[dict], list[str]]:
     consumed_ids: list[str] = []
     for section in sections:
         if not merged:
-            merged.append(dict(section))
+            merged.append(section if inplace else dict(section))
             continue
 
         prev = merged[-1]
@@ -438,9 +675,8 @@ def _merge_sections(sections: list[dict]) -> tuple[list[dict], list[str]]:
             # Merge: append current content to previous block
             joiner = " " if not prev["content"].rstrip().endswith("\n") else ""
             prev["content"] = prev["content"].rstrip() + joiner + section["content"].lstrip()
-            # Keep the more "specific" type if they differ (equation > note > step)
-            type_priority = {"equation": 3, "definition": 3, "step": 2, "note": 1}
-            if type_priority.get(section.get("type", ""), 0) > type_priority.get(prev.get("type", ""), 0):
+            # Keep the more "specific" type if they differ
+            if _TYPE_PRIORITY.get(section.get("type", ""), 0) > _TYPE_PRIORITY.get(prev.get("type", ""), 0):
                 prev["type"] = section["type"]
             sid = section.get("section_id")
             if sid:
@@ -449,16 +685,17 @@ def _merge_sections(sections: list[dict]) -> tuple[list[dict], list[str]]:
                 f"Merged section {section.get('section_id')} into {prev.get('section_id')}"
             )
         else:
-            merged.append(dict(section))
+            merged.append(section if inplace else dict(section))
 
     return merged, consumed_ids
 
 
-def send_image_to_gemini(
-    image_path: str,
+async def send_image_to_gemini(
+    image: bytes,
+    mime: str,
     generate_diagrams: bool = True,
     existing_sections: list[dict] | None = None,
-    previous_image_b64: str | None = None,
+    previous_image: bytes | None = None,
     previous_image_mime: str | None = None,
 ) -> tuple[list[dict], list[str]]:
     """Process chalkboard image and optionally generate images for diagrams.
@@ -467,12 +704,13 @@ def send_image_to_gemini(
     attached as '_image_bytes' and '_image_ext' keys (to be uploaded by the caller).
 
     Args:
-        image_path: Path to the chalkboard image.
+        image: Raw bytes of the chalkboard image.
+        mime: MIME type of the image.
         generate_diagrams: Whether to generate enhanced diagram images.
         existing_sections: Section summaries already stored for this room
             (each dict has section_id, type, content_preview), used to avoid
             duplicating notes across captures.
-        previous_image_b64: Base64-encoded previous capture image (if available).
+        previous_image: Raw bytes of the previous capture (if available).
         previous_image_mime: MIME type of the previous image.
 
     Returns:
@@ -480,40 +718,50 @@ def send_image_to_gemini(
         consumed_ids lists any section_ids that were merged into another
         block and should be deleted from the DB.
     """
-    with open(image_path, "rb") as f:
-        image_data = base64.b64encode(f.read()).decode("utf-8")
-
-    ext = image_path.lower().rsplit(".", 1)[-1] if "." in image_path else "jpeg"
-    mime = {"jpg": "image/jpeg", "jpeg": "image/jpeg", "png": "image/png"}.get(ext, "image/jpeg")
+    # Encoded once here; the diagram calls below reuse the same data.
+    image_data = await asyncio.to_thread(pybase64.b64encode_as_string, image)
 
-    has_previous = previous_image_b64 is not None
+    has_previous = previous_image is not None
     existing_ids = [s["section_id"] for s in existing_sections] if existing_sections else []
-    prompt = _build_prompt(existing_sections, has_previous_image=has_previous)
+    prompt_prefix, prompt_context = _build_prompt(existing_sections, has_previous_image=has_previous)
+
+    # Same frame(s) + same prompt → same answer; skip the model.
+    cache_key = None
+    if RESULT_CACHE_SIZE:
+        digests = await asyncio.to_thread(_capture_digests, image, previous_image)
+        cache_key = (*digests, prompt_prefix, prompt_context, generate_diagrams)
+        cached = _result_cache.get(cache_key)
+        if cached is not None and cached[0] > time.monotonic():
+            _result_cache.move_to_end(cache_key)
+            logger.info("Repeat capture (sha256=%.16s); reusing previous result", digests[0])
+            return _copy_result(cached[1])
     logger.info(
         f"Sending image to OpenRouter model={OPENROUTER_MODEL}, mime={mime}, "
         f"base64_len={len(image_data)}, existing_ids={existing_ids}, "
         f"has_previous_frame={has_previous}"
     )
 
-    # Build message content: prompt text + optional previous image + current image
-    content_parts: list[dict] = [{"type": "text", "text": prompt}]
+    # Build message content: cached static prompt + room context + optional
+    # previous image + current image
+    content_parts: list[dict] = [
+        {"type": "text", "text": prompt_prefix, "cache_control": {"type": "ephemeral"}},
+    ]
+    if prompt_context:
+        content_parts.append({"type": "text", "text": prompt_context})
     if has_previous:
+        # Encoded only here, off the event loop; the caller keeps raw bytes.
+        previous_b64 = await asyncio.to_thread(pybase64.b64encode_as_string, previous_image)
         content_parts.append({
             "type": "image_url",
-            "image_url": {"url": f"data:{previous_image_mime};base64,{previous_image_b64}"},
+            "image_url": {"url": f"data:{previous_image_mime};base64,{previous_b64}"},
         })
     content_parts.append({
         "type": "image_url",
         "image_url": {"url": f"data:{mime};base64,{image_data}"},
     })
 
-    resp = requests.post(
-        "https://openrouter.ai/api/v1/chat/completions",
-        headers={
-            "Authorization": f"Bearer {OPENROUTER_API_KEY}",
-            "Content-Type": "application/json",
-        },
-        json={
+    resp = await _post_openrouter(
+        {
             "model": OPENROUTER_MODEL,
             "messages": [
                 {
@@ -525,42 +773,64 @@ def send_image_to_gemini(
         timeout=120,
     )
 
-    if not resp.ok:
+    if not resp.is_success:
         logger.error(f"OpenRouter responded {resp.status_code}: {resp.text[:1000]}")
     resp.raise_for_status()
 
-    text = resp.json()["choices"][0]["message"]["content"].strip()
+    # Parse the raw body bytes directly rather than via resp.json().
+    text = orjson.loads(resp.content)["choices"][0]["message"]["content"].strip()
 
-    # Strip markdown code block wrappers if present
-    match = re.search(r"```(?:json)?\s*\n?(.*?)```", text, re.DOTALL)
-    if match:
-        text = match.group(1).strip()
+    # Strip markdown code block wrappers if present.  The usual answer is a
+    # bare JSON array, so only run the regex when there is a fence at all.
+    if "```" in text:
+        match = _CODE_FENCE_RE.search(text)
+        if match:
+            text = match.group(1).strip()
 
-    text = fix_latex_json(text)
-    logger.info(f"AI response (fixed): {text[:500]}")
-    sections = json.loads(text)
+    logger.info("AI response: %.500s", text)
+    # Copy the memoized dicts: callers mutate sections (merging, image bytes).
+    sections = [dict(s) for s in _parse_sections(text)]
 
-    # Post-process: merge blocks that were incorrectly split mid-sentence
-    sections, consumed_ids = _merge_sections(sections)
-    logger.info(f"After merging: {len(sections)} sections, consumed IDs: {consumed_ids}")
+    # Post-process: merge blocks that were incorrectly split mid-sentence.
+    # The copies above are ours, so merge into them directly.
+    sections, consumed_ids = _merge_sections(sections, inplace=True)
+    logger.info("After merging: %d sections, consumed IDs: %s", len(sections), consumed_ids)
 
     if generate_diagrams:
-        for section in sections:
-            sid = section.get("section_id")
-            if section.get("type") != "diagram":
-                continue
-
-            result = generate_diagram_image(
-                image_path,
-                diagram_description=section.get("content"),
+        # The image-gen calls are independent, so run them concurrently:
+        # wall time is the slowest diagram rather than the sum of all of them.
+        # Diagrams with the same description produce the identical request
+        # (same photo, description and caption), so each distinct one is
+        # generated once and shared.
+        diagrams = [s for s in sections if s.get("type") == "diagram"]
+        descriptions = list(dict.fromkeys(s.get("content") for s in diagrams))
+        generated = dict(zip(descriptions, await asyncio.gather(*(
+            generate_diagram_image(
+                image_data,
+                mime,
+                diagram_description=description,
                 all_sections=sections,
             )
+            for description in descriptions
+        ))))
+        for section in diagrams:
+            result = generated[section.get("content")]
+            sid = section.get("section_id")
             if result:
                 img_bytes, img_ext = result
                 section["_image_bytes"] = img_bytes
                 section["_image_ext"] = img_ext
-                logger.info(f"Generated diagram for section {sid}")
+                logger.info("Generated diagram for section %s", sid)
             else:
                 logger.warning(f"Diagram generation failed for section {sid}")
-    
+
+    if cache_key is not None:
+        _result_cache[cache_key] = (
+            time.monotonic() + RESULT_CACHE_TTL,
+            _copy_result((sections, consumed_ids)),
+        )
+        _result_cache.move_to_end(cache_key)
+        if len(_result_cache) > RESULT_CACHE_SIZE:
+            _result_cache.popitem(last=False)
+
     return sections, consumed_ids
@@ -0,0 +1,136 @@
+"""Rule-based conversion of LaTeX-laden lecture notes into speakable text."""
+
+import re
+import functools
+
+# Math regions: $$...$$, $...$, \[...\], \(...\)
+_MATH_RE = re.compile(r"\$\$(.+?)\$\$|\$(.+?)\$|\\\[(.+?)\\\]|\\\((.+?)\\\)", re.DOTALL)
+
+# A sub/superscript argument: {braced group} or a single token / command.
+_ARG = r"(?:\{([^{}]*)\}|(\\[a-zA-Z]+|[^\s{}\\]))"
+
+# Structural rules, applied repeatedly so nested groups unwind innermost-first.
+_STRUCTURE_RULES = [
+    (re.compile(r"\\(?:begin|end)\{[^{}]*\}"), " "),
+    (re.compile(r"\\[dt]?frac\{([^{}]*)\}\{([^{}]*)\}"), r" \1 over \2 "),
+    (re.compile(r"\\sqrt\{([^{}]*)\}"), r" the square root of \1 "),
+    (re.compile(r"\\vec\{([^{}]*)\}"), r" vector \1 "),
+    (re.compile(r"\\hat\{([^{}]*)\}"), r" \1 hat "),
+    (re.compile(r"\\(?:bar|overline)\{([^{}]*)\}"), r" \1 bar "),
+    (re.compile(r"\\dot\{([^{}]*)\}"), r" \1 dot "),
+    (
+        re.compile(r"\\(?:text|mathrm|mathit|mathbf|mathbb|mathcal|boldsymbol|operatorname)\{([^{}]*)\}"),
+        r" \1 ",
+    ),
+]
+
+_RANGE_OPS = {"int": "the integral", "sum": "the sum", "prod": "the product"}
+_RANGE_RE = re.compile(r"\\(int|sum|prod)_" + _ARG + r"\^" + _ARG)
+_LIMIT_RE = re.compile(r"\\lim_" + _ARG)
+_SUPERSCRIPT_RE = re.compile(r"\^" + _ARG)
+_SUBSCRIPT_RE = re.compile(r"_" + _ARG)
+
+_GREEK = (
+    "alpha beta gamma delta epsilon varepsilon zeta eta theta vartheta iota kappa "
+    "lambda mu nu xi pi rho sigma tau upsilon phi varphi chi psi omega"
+).split()
+
+_WORDS = {
+    **{name: name.removeprefix("var") for name in _GREEK},
+    **{name.capitalize(): "capital " + name for name in _GREEK if not name.startswith("var")},
+    "cdot": "times", "times": "times", "div": "divided by", "pm": "plus or minus",
+    "mp": "minus or plus", "le": "less than or equal to", "leq": "less than or equal to",
+    "ge": "greater than or equal to", "geq": "greater than or equal to",
+    "neq": "not equal to", "ne": "not equal to", "approx": "approximately",
+    "equiv": "is equivalent to", "sim": "is similar to", "propto": "is proportional to",
+    "infty": "infinity", "partial": "partial", "nabla": "del", "to": "to",
+    "rightarrow": "goes to", "Rightarrow": "implies", "implies": "implies",
+    "iff": "if and only if", "in": "in", "notin": "not in", "subset": "subset of",
+    "subseteq": "subset of", "cup": "union", "cap": "intersect", "forall": "for all",
+    "exists": "there exists", "int": "the integral of", "sum": "the sum of",
+    "prod": "the product of", "lim": "the limit of", "sin": "sine", "cos": "cosine",
+    "tan": "tangent", "sec": "secant", "csc": "cosecant", "cot": "cotangent",
+    "arcsin": "arc sine", "arccos": "arc cosine", "arctan": "arc tangent",
+    "ln": "natural log", "log": "log", "exp": "exp", "det": "determinant",
+    "max": "max", "min": "min", "deg": "degrees", "circ": "degrees", "prime": "prime",
+    "ldots": "dot dot dot", "cdots": "dot dot dot", "dots": "dot dot dot",
+    "left": "", "right": "", "quad": "", "qquad": "", "displaystyle": "",
+}
+_COMMAND_RE = re.compile(r"\\([a-zA-Z]+)")
+
+_SYMBOLS = [
+    (re.compile(r"\\\\"), ", "),
+    (re.compile(r"\\[,;:! ]|&"), " "),
+    (re.compile(r"="), " equals "),
+    (re.compile(r"\+"), " plus "),
+    (re.compile(r"-"), " minus "),
+    (re.compile(r"<"), " less than "),
+    (re.compile(r">"), " greater than "),
+    (re.compile(r"'"), " prime "),
+    (re.compile(r"[{}|]"), " "),
+]
+
+_SPACES_RE = re.compile(r"[ \t]+")
+
+# Whatever LaTeX the rules left behind, for the non-strict mode to drop.
+_RESIDUAL_RE = re.compile(r"\\[a-zA-Z]+|[\\$^_]")
+
+
+def _arg(match: re.Match, index: int) -> str:
+    """The sub/superscript argument captured at group pair `index`."""
+    braced, token = match.group(index), match.group(index + 1)
+    return braced if braced is not None else token
+
+
+def _superscript(match: re.Match) -> str:
+    power = _arg(match, 1).strip()
+    if power == "2":
+        return " squared "
+    if power == "3":
+        return " cubed "
+    if power in ("\\prime", "'"):
+        return " prime "
+    return f" to the power of {power} "
+
+
+def _speak_math(math: str) -> str:
+    """Spell out one math region, or leave residual LaTeX for the caller to detect."""
+    math = _RANGE_RE.sub(
+        lambda m: f" {_RANGE_OPS[m.group(1)]} from {_arg(m, 2)} to {_arg(m, 4)} of ", math
+    )
+    math = _LIMIT_RE.sub(
+        lambda m: " the limit as " + _arg(m, 1).replace("\\to", " approaches ") + " of ", math
+    )
+    while True:
+        previous = math
+        for pattern, spoken in _STRUCTURE_RULES:
+            math = pattern.sub(spoken, math)
+        math = _SUPERSCRIPT_RE.sub(_superscript, math)
+        math = _SUBSCRIPT_RE.sub(lambda m: f" sub {_arg(m, 1)} ", math)
+        if math == previous:
+            break
+    math = _COMMAND_RE.sub(lambda m: " " + _WORDS.get(m.group(1), m.group(0)) + " ", math)
+    for pattern, spoken in _SYMBOLS:
+        math = pattern.sub(spoken, math)
+    return f" {math} "
+
+
+@functools.lru_cache(maxsize=256)
+def latex_to_speech(text: str, strict: bool = True) -> str | None:
+    """Return `text` with its LaTeX math spelled out for text-to-speech.
+
+    Covers the constructs lecture notes mostly contain (fractions, powers,
+    subscripts, roots, integrals/sums/limits, Greek letters, relations).
+    When anything is left that the rules don't understand, strict mode
+    returns None so the caller can fall back to a slower, smarter
+    conversion; otherwise the leftover markup is simply dropped.
+    """
+    if "$" not in text and "\\" not in text:
+        return text
+    spoken = _MATH_RE.sub(lambda m: _speak_math(next(g for g in m.groups() if g is not None)), text)
+    if "\\" in spoken or "$" in spoken or "^" in spoken or "_" in spoken:
+        if strict:
+            return None
+        spoken = _RESIDUAL_RE.sub(" ", spoken)
+    lines = (_SPACES_RE.sub(" ", line).strip() for line in spoken.split("\n"))
+    return "\n".join(lines).replace(" ,", ",").replace(" .", ".")
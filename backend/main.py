@@ -1,40 +1,67 @@
 import os
-import uuid
+import re
+import secrets
+import hashlib
 import asyncio
-import base64
+import time
 import logging
-import tempfile
-from pathlib import Path
+import weakref
+from collections import OrderedDict
+from contextlib import asynccontextmanager
 
+import httpx
+import orjson
 from dotenv import load_dotenv
 
 load_dotenv()
 
-from fastapi import FastAPI, UploadFile, File, HTTPException
+from fastapi import FastAPI, UploadFile, File, HTTPException, Request, Depends
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse
-from elevenlabs.client import ElevenLabs
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import ORJSONResponse, RedirectResponse, Response, StreamingResponse
+from starlette.background import BackgroundTask
 
 from supabase_client import (
     create_room,
     get_room_by_code,
     get_all_rooms,
-    verify_professor_key,
     upsert_notes,
     delete_notes,
-    get_notes_for_room,
+    get_notes_by_code,
     get_existing_sections_summary,
-    increment_highlight,
-    add_comment,
-    get_comments_for_room,
+    highlight_by_code,
+    add_highlights,
+    get_comments_by_code,
     upload_diagram,
+    get_tts_audio_url,
+    upload_tts_audio,
+    get_pool as get_db_pool,
+    get_client as get_supabase_client,
+    aclose as close_supabase_client,
 )
-from gemini_service import send_image_to_gemini
+from latex_speech import latex_to_speech
+from gemini_service import send_image_to_gemini, shrink_image, aclose as close_gemini_client
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Open the database pool and Supabase client up front so the first
+    # request doesn't pay for them
+    if os.getenv("DATABASE_URL"):
+        await get_db_pool()
+    if os.getenv("SUPABASE_URL") and os.getenv("SUPABASE_KEY"):
+        await get_supabase_client()
+    yield
+    await _highlights.aclose()
+    await close_gemini_client()
+    await close_supabase_client()
+    await _http_client.aclose()
+
+
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
 
 
 @app.get("/")
@@ -57,20 +84,188 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Per-room locks to serialise image uploads and prevent duplicate sections
-_room_locks: dict[str, asyncio.Lock] = {}
+# Notes/comments JSON (LaTeX, URLs, UUIDs) compresses several-fold
+app.add_middleware(GZipMiddleware, minimum_size=1024, compresslevel=5)
+
+# Shared async HTTP client for the TTS calls (HTTP/2 + keep-alive), so the
+# /tts endpoint awaits its requests instead of parking a worker thread.
+_http_client = httpx.AsyncClient(
+    http2=True,
+    timeout=15.0,
+    limits=httpx.Limits(max_keepalive_connections=20),
+)
+
+# MIME type by file extension, for uploaded captures and generated diagrams
+_MIME_BY_EXT = {"jpg": "image/jpeg", "jpeg": "image/jpeg", "png": "image/png"}
+
+# Per-room capture pipelines (see _RoomPipeline).  Held weakly: a pipeline
+# lives only while a request or its worker task references it, so rooms that
+# go quiet don't leave one behind forever.
+_room_pipelines: weakref.WeakValueDictionary[str, "_RoomPipeline"] = weakref.WeakValueDictionary()
+
+# Store the previous capture's image per room so we can send two frames to
+# the AI for occlusion handling (professor blocking the board).  Each entry
+# is (raw image bytes, mime_type); the least recently updated rooms are
+# evicted past MAX_PREVIOUS_CAPTURES so idle rooms don't pin their frames.
+MAX_PREVIOUS_CAPTURES = int(os.getenv("MAX_PREVIOUS_CAPTURES", "64"))
+_previous_captures: OrderedDict[str, tuple[bytes, str]] = OrderedDict()
+
+# Room lookups by join code: (expires_at, room or None).  Codes never change
+# for a room, so a short TTL only bounds how long a deactivated room keeps
+# resolving; misses expire sooner so a new code isn't stuck on 404.
+ROOM_CACHE_TTL = 60.0
+ROOM_CACHE_MISS_TTL = 5.0
+ROOM_CACHE_SIZE = 10_000
+_room_cache: OrderedDict[str, tuple[float, dict | None]] = OrderedDict()
+
+
+def _cache_room(code: str, room: dict | None) -> None:
+    ttl = ROOM_CACHE_TTL if room is not None else ROOM_CACHE_MISS_TTL
+    _room_cache[code] = (time.monotonic() + ttl, room)
+    _room_cache.move_to_end(code)
+    if len(_room_cache) > ROOM_CACHE_SIZE:
+        _room_cache.popitem(last=False)
+
+
+async def _resolve_room(code: str) -> dict | None:
+    """get_room_by_code, served from _room_cache while the entry is fresh."""
+    code = code.upper()
+    cached = _room_cache.get(code)
+    if cached is not None and cached[0] > time.monotonic():
+        return cached[1]
+    room = await get_room_by_code(code)
+    if room is None and cached is not None and cached[1] is not None:
+        # The room is gone; so are its notes
+        _sections_cache.pop(cached[1]["id"], None)
+    _cache_room(code, room)
+    return room
+
+
+async def room_dep(code: str) -> dict:
+    """FastAPI dependency: the active room for the `code` path parameter, or 404."""
+    room = await _resolve_room(code)
+    if not room:
+        raise HTTPException(404, "Room not found")
+    return room
+
 
-# Store the previous capture's image (base64) per room so we can send two
-# frames to the AI for occlusion handling (professor blocking the board).
-# Each entry is (base64_data, mime_type).
-_previous_captures: dict[str, tuple[str, str]] = {}
+# Per-room summary of the sections already stored, keyed by section_id in DB
+# order: (expires_at, summary).  This process's own writes are applied to it
+# locally, so the room pipeline doesn't re-read it from the database on every
+# frame; the TTL bounds staleness from writes made elsewhere (other workers,
+# dashboard, clear_db.py).
+SECTIONS_CACHE_TTL = 60.0
+SECTIONS_CACHE_SIZE = 1024
+_sections_cache: OrderedDict[str, tuple[float, dict[str, dict]]] = OrderedDict()
+
+
+async def _get_sections_summary(room_id: str) -> list[dict]:
+    """Return the existing-sections summary for a room, from _sections_cache while fresh."""
+    cached = _sections_cache.get(room_id)
+    if cached is not None and cached[0] > time.monotonic():
+        return list(cached[1].values())
+    summary = await get_existing_sections_summary(room_id)
+    sections = {s["section_id"]: s for s in summary}
+    _sections_cache[room_id] = (time.monotonic() + SECTIONS_CACHE_TTL, sections)
+    _sections_cache.move_to_end(room_id)
+    if len(_sections_cache) > SECTIONS_CACHE_SIZE:
+        _sections_cache.popitem(last=False)
+    return list(sections.values())
+
+
+def _update_sections_cache(room_id: str, sections: list[dict], deleted_ids: list[str]) -> None:
+    """Apply a successful delete_notes/upsert_notes to the cached summary."""
+    entry = _sections_cache.get(room_id)
+    if entry is None:
+        return
+    cached = entry[1]
+    for section_id in deleted_ids:
+        cached.pop(section_id, None)
+    for s in sections:
+        cached[s["section_id"]] = {
+            "section_id": s["section_id"],
+            "type": s["type"],
+            "content_preview": (s.get("content") or "")[:150],
+            "image_url": s.get("image_url"),
+        }
 
 
-def _get_room_lock(room_id: str) -> asyncio.Lock:
-    """Return (or create) an asyncio.Lock for the given room."""
-    if room_id not in _room_locks:
-        _room_locks[room_id] = asyncio.Lock()
-    return _room_locks[room_id]
+# Serialized GET /notes and /comments bodies per room, with their ETags.
+# Writes made by this process drop a room's entries right away; the short
+# TTL bounds staleness from writes made elsewhere (other workers, dashboard).
+# Just past the TTL an entry is still served while one background fetch
+# refreshes it, so a burst of polls never waits on Supabase.
+RESPONSE_CACHE_TTL = 2.0
+RESPONSE_CACHE_STALE = 10.0
+_response_cache: dict[tuple[str, str], tuple[float, str, bytes]] = {}
+_response_refreshes: dict[tuple[str, str], asyncio.Task] = {}
+# Bumped on every invalidation so a fetch that raced a write isn't cached.
+_room_versions: dict[str, int] = {}
+
+
+def _invalidate_room_responses(room_id: str) -> None:
+    """Forget the cached notes/comments bodies of a room after a write."""
+    _room_versions[room_id] = _room_versions.get(room_id, 0) + 1
+    _response_cache.pop(("notes", room_id), None)
+    _response_cache.pop(("comments", room_id), None)
+
+
+async def _fetch_room_response(key: tuple[str, str], code: str, fetch) -> tuple[float, str, bytes] | None:
+    """Fetch, serialize and cache one room response; None if the room is gone."""
+    room_id = key[1]
+    version = _room_versions.get(room_id, 0)
+    data = await fetch(code)
+    if data is None:
+        _response_cache.pop(key, None)
+        return None
+    body = orjson.dumps(data)
+    etag = '"' + hashlib.blake2b(body, digest_size=16).hexdigest() + '"'
+    entry = (time.monotonic() + RESPONSE_CACHE_TTL, etag, body)
+    if _room_versions.get(room_id, 0) == version:
+        _response_cache[key] = entry
+    return entry
+
+
+async def _refresh_room_response(key: tuple[str, str], code: str, fetch) -> None:
+    try:
+        await _fetch_room_response(key, code, fetch)
+    except Exception as e:
+        logger.error("Failed to refresh cached %s for room %s: %s", key[0], key[1], e)
+    finally:
+        _response_refreshes.pop(key, None)
+
+
+async def _cached_room_response(request: Request, kind: str, room: dict, fetch) -> Response:
+    """Serve `fetch(code)` as JSON with an ETag, answering 304 when unchanged."""
+    key = (kind, room["id"])
+    now = time.monotonic()
+    entry = _response_cache.get(key)
+    if entry is not None and now >= entry[0]:
+        if now < entry[0] + RESPONSE_CACHE_STALE:
+            if key not in _response_refreshes:
+                _response_refreshes[key] = asyncio.create_task(
+                    _refresh_room_response(key, room["code"], fetch)
+                )
+        else:
+            entry = None
+    if entry is None:
+        entry = await _fetch_room_response(key, room["code"], fetch)
+        if entry is None:
+            raise HTTPException(404, "Room not found")
+    _, etag, body = entry
+
+    headers = {"ETag": etag, "Cache-Control": "private, max-age=2"}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    return Response(body, media_type="application/json", headers=headers)
+
+
+def _get_room_pipeline(room_id: str) -> "_RoomPipeline":
+    """Return (or create) the capture pipeline for the given room."""
+    pipeline = _room_pipelines.get(room_id)
+    if pipeline is None:
+        pipeline = _room_pipelines[room_id] = _RoomPipeline(room_id)
+    return pipeline
 
 
 # ---------------------------------------------------------------------------
@@ -80,36 +275,35 @@ def _get_room_lock(room_id: str) -> asyncio.Lock:
 @app.get("/rooms")
 async def api_list_rooms():
     """List all active rooms with note counts."""
-    return get_all_rooms()
+    return await get_all_rooms()
 
 
 @app.post("/rooms")
 async def api_create_room(body: dict | None = None):
     """Create a new room. Returns the room object with its join code."""
     name = body.get("name") if body else None
-    room = create_room(name)
+    room = await create_room(name)
+    _cache_room(room["code"], room)
     logger.info(f"Room created: {room['code']}")
     return room
 
 
 @app.get("/rooms/{code}")
-async def api_get_room(code: str):
+async def api_get_room(room: dict = Depends(room_dep)):
     """Look up a room by its join code."""
-    room = get_room_by_code(code)
-    if not room:
-        raise HTTPException(404, "Room not found or inactive")
     # Never expose professor_key to GET requests
     room_safe = {k: v for k, v in room.items() if k != "professor_key"}
     return room_safe
 
 
 @app.post("/rooms/{code}/verify-professor")
-async def api_verify_professor(code: str, body: dict):
+async def api_verify_professor(body: dict, room: dict = Depends(room_dep)):
     """Verify the professor secret key for a room."""
     key = body.get("key", "")
     if not key:
         raise HTTPException(400, "key is required")
-    if not verify_professor_key(code, key):
+    expected = (room.get("professor_key") or "").encode()
+    if not secrets.compare_digest(expected, str(key).encode()):
         raise HTTPException(403, "Invalid professor key")
     return {"ok": True}
 
@@ -118,150 +312,314 @@ async def api_verify_professor(code: str, body: dict):
 # Notes endpoints (room-scoped)
 # ---------------------------------------------------------------------------
 
-@app.post("/rooms/{code}/upload-image")
-async def upload_image(code: str, file: UploadFile = File(...)):
-    """Upload a chalkboard image for processing in a specific room."""
-    room = get_room_by_code(code)
-    if not room:
-        raise HTTPException(404, "Room not found")
+async def _process_capture(room_id: str, contents: bytes, current_mime: str) -> dict:
+    """Run one capture through the model and write the results to Supabase."""
+    existing_sections = await _get_sections_summary(room_id)
 
-    # Save upload to a temp file (cleaned up automatically)
-    contents = await file.read()
-    ext = Path(file.filename).suffix if file.filename else ".jpg"
-    with tempfile.NamedTemporaryFile(suffix=ext, delete=False) as tmp:
-        tmp.write(contents)
-        tmp_path = tmp.name
-
-    # Read the current image into base64 before entering the lock
-    # (we'll store it as the "previous" capture after processing).
-    current_b64 = base64.b64encode(contents).decode("utf-8")
-    current_mime = {"jpg": "image/jpeg", "jpeg": "image/jpeg", "png": "image/png"}.get(
-        ext.lstrip(".").lower(), "image/jpeg"
-    )
+    # Retrieve the previous frame for this room (if any)
+    prev = _previous_captures.get(room_id)
+    prev_bytes = prev[0] if prev else None
+    prev_mime = prev[1] if prev else None
 
-    # Acquire per-room lock so concurrent uploads are processed one at a
-    # time, ensuring each request sees the section IDs written by the
-    # previous one (prevents duplicate diagrams / section IDs).
-    lock = _get_room_lock(room["id"])
-    async with lock:
-        existing_sections = get_existing_sections_summary(room["id"])
+    try:
+        sections, consumed_ids = await send_image_to_gemini(
+            contents,
+            current_mime,
+            True,
+            existing_sections,
+            prev_bytes,
+            prev_mime,
+        )
+    except Exception as e:
+        logger.error(f"Gemini API error: {e}")
+        raise HTTPException(502, f"Failed to process image: {e}")
+
+    # Delete DB rows for sections that were merged into another block
+    if consumed_ids:
+        await delete_notes(room_id, consumed_ids)
+        _update_sections_cache(room_id, [], consumed_ids)
+        _invalidate_room_responses(room_id)
+
+    # Store current image as the previous capture for next time
+    _previous_captures[room_id] = (contents, current_mime)
+    _previous_captures.move_to_end(room_id)
+    if len(_previous_captures) > MAX_PREVIOUS_CAPTURES:
+        _previous_captures.popitem(last=False)
+
+    # Build a lookup of existing sections that already have images
+    existing_images = {
+        s["section_id"]: s["image_url"]
+        for s in existing_sections
+        if s.get("image_url")
+    }
 
-        # Retrieve the previous frame for this room (if any)
-        prev = _previous_captures.get(room["id"])
-        prev_b64 = prev[0] if prev else None
-        prev_mime = prev[1] if prev else None
+    # Upload any generated diagram images to Supabase Storage, all at once.
+    # If new image bytes were generated, always upload them (replaces old image).
+    # If generation failed/skipped but an existing image exists, keep it as fallback.
+    pending = []
+    for section in sections:
+        img_bytes = section.pop("_image_bytes", None)
+        img_ext = section.pop("_image_ext", None)
+
+        if img_bytes and img_ext:
+            # New image generated — upload and use it
+            mime = _MIME_BY_EXT.get(img_ext, "image/png")
+            # Named by content, so re-generating the same diagram (e.g. a
+            # diagram cache hit) reuses the stored object and its URL
+            digest = hashlib.blake2b(img_bytes, digest_size=16).hexdigest()
+            filename = f"diagram_{digest}.{img_ext}"
+            pending.append((section, upload_diagram(filename, img_bytes, mime)))
+        else:
+            # No new image bytes — keep existing image as fallback
+            existing_url = existing_images.get(section.get("section_id"))
+            if existing_url:
+                section["image_url"] = existing_url
+                logger.info(
+                    "Keeping existing image for section %s (no new image generated)",
+                    section.get("section_id"),
+                )
+
+    results = await asyncio.gather(*(upload for _, upload in pending), return_exceptions=True)
+    for (section, _), result in zip(pending, results):
+        if isinstance(result, Exception):
+            logger.error(f"Failed to upload diagram to storage: {result}")
+            # Fall back to existing image if upload fails
+            existing_url = existing_images.get(section.get("section_id"))
+            if existing_url:
+                section["image_url"] = existing_url
+        else:
+            section["image_url"] = result
+            logger.info("Uploaded new diagram for section %s", section.get("section_id"))
+
+    # Write results to Supabase — Realtime will push updates to clients
+    notes = await upsert_notes(room_id, sections)
+    _update_sections_cache(room_id, sections, [])
+    if notes:
+        _invalidate_room_responses(room_id)
 
-        try:
-            sections, consumed_ids = await asyncio.to_thread(
-                send_image_to_gemini,
-                tmp_path,
-                True,
-                existing_sections,
-                prev_b64,
-                prev_mime,
-            )
-        except Exception as e:
-            logger.error(f"Gemini API error: {e}")
-            raise HTTPException(502, f"Failed to process image: {e}")
-        finally:
-            # Clean up temp file
-            Path(tmp_path).unlink(missing_ok=True)
+    return {"sections": sections, "notes": notes}
 
-        # Delete DB rows for sections that were merged into another block
-        if consumed_ids:
-            delete_notes(room["id"], consumed_ids)
 
-        # Store current image as the previous capture for next time
-        _previous_captures[room["id"]] = (current_b64, current_mime)
+class _RoomPipeline:
+    """Latest-frame-wins processing of one room's captures.
 
-        # Build a lookup of existing sections that already have images
-        existing_images = {
-            s["section_id"]: s["image_url"]
-            for s in existing_sections
-            if s.get("image_url")
-        }
+    Frames are processed one at a time, so each sees the section IDs written
+    by the previous one (prevents duplicate diagrams / section IDs).  A frame
+    that arrives while another is in flight waits in a single pending slot;
+    a newer frame replaces it, and the callers of every replaced frame get
+    the result of the frame that superseded theirs.
+    """
 
-        # Upload any generated diagram images to Supabase Storage.
-        # If new image bytes were generated, always upload them (replaces old image).
-        # If generation failed/skipped but an existing image exists, keep it as fallback.
-        for section in sections:
-            img_bytes = section.pop("_image_bytes", None)
-            img_ext = section.pop("_image_ext", None)
-
-            if img_bytes and img_ext:
-                # New image generated — upload and use it
-                mime = {"png": "image/png", "jpg": "image/jpeg", "jpeg": "image/jpeg"}.get(img_ext, "image/png")
-                filename = f"diagram_{uuid.uuid4()}.{img_ext}"
+    def __init__(self, room_id: str):
+        self.room_id = room_id
+        self.pending: tuple[bytes, str] | None = None
+        self.waiters: list[asyncio.Future] = []
+        self.worker: asyncio.Task | None = None
+
+    async def submit(self, contents: bytes, mime: str) -> dict:
+        """Queue a frame and wait for the result that covers it."""
+        if self.pending is not None:
+            logger.info("Dropping superseded capture for room %s", self.room_id)
+        self.pending = (contents, mime)
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters.append(waiter)
+        if self.worker is None:
+            # A separate task, so one client disconnecting doesn't abandon
+            # the frames other callers are waiting on.
+            self.worker = asyncio.create_task(self._run())
+        return await waiter
+
+    async def _run(self) -> None:
+        try:
+            while self.pending is not None:
+                (contents, mime), waiters = self.pending, self.waiters
+                self.pending, self.waiters = None, []
                 try:
-                    public_url = upload_diagram(filename, img_bytes, mime)
-                    section["image_url"] = public_url
-                    logger.info(f"Uploaded new diagram for section {section.get('section_id')}")
+                    result = await _process_capture(self.room_id, contents, mime)
+                except asyncio.CancelledError:
+                    for waiter in waiters + self.waiters:
+                        waiter.cancel()
+                    raise
                 except Exception as e:
-                    logger.error(f"Failed to upload diagram to storage: {e}")
-                    # Fall back to existing image if upload fails
-                    existing_url = existing_images.get(section.get("section_id"))
-                    if existing_url:
-                        section["image_url"] = existing_url
-            else:
-                # No new image bytes — keep existing image as fallback
-                existing_url = existing_images.get(section.get("section_id"))
-                if existing_url:
-                    section["image_url"] = existing_url
-                    logger.info(f"Keeping existing image for section {section.get('section_id')} (no new image generated)")
-
-        # Write results to Supabase — Realtime will push updates to clients
-        upsert_notes(room["id"], sections)
-        notes = get_notes_for_room(room["id"])
+                    for waiter in waiters:
+                        if not waiter.done():
+                            waiter.set_exception(e)
+                else:
+                    for waiter in waiters:
+                        if not waiter.done():
+                            waiter.set_result(result)
+        finally:
+            self.worker = None
 
-    return {"sections": sections, "notes": notes}
+
+async def _submit_capture(room_id: str, contents: bytes, mime: str) -> dict:
+    """Shrink an uploaded capture and queue it on its room's pipeline."""
+    # Large photos are shrunk once up front (off the event loop) so the model
+    # calls, the diagram calls and the stored "previous" frame all carry the
+    # smaller image.
+    contents, mime = await asyncio.to_thread(shrink_image, contents, mime)
+    return await _get_room_pipeline(room_id).submit(contents, mime)
+
+
+@app.post("/rooms/{code}/upload-image")
+async def upload_image(file: UploadFile = File(...), room: dict = Depends(room_dep)):
+    """Upload a chalkboard image (multipart form) for processing in a room.
+
+    Legacy form of /upload-image-raw, kept for existing capture clients.
+    """
+    contents = await file.read()
+    ext = file.filename.rpartition(".")[2].lower() if file.filename else "jpg"
+    current_mime = _MIME_BY_EXT.get(ext, "image/jpeg")
+    return await _submit_capture(room["id"], contents, current_mime)
+
+
+@app.post("/rooms/{code}/upload-image-raw")
+async def upload_image_raw(request: Request, room: dict = Depends(room_dep)):
+    """Upload a chalkboard image sent as the raw request body.
+
+    The Content-Type header gives the image type (image/jpeg or image/png);
+    skipping multipart avoids the form parsing and its extra buffer copy.
+    """
+    contents = await request.body()
+    if not contents:
+        raise HTTPException(400, "Request body is empty")
+    current_mime = request.headers.get("content-type", "").partition(";")[0].strip().lower()
+    if current_mime not in _MIME_BY_EXT.values():
+        current_mime = "image/jpeg"
+    return await _submit_capture(room["id"], contents, current_mime)
 
 
 @app.get("/rooms/{code}/notes")
-async def api_get_notes(code: str):
+async def api_get_notes(request: Request, room: dict = Depends(room_dep)):
     """Get all notes for a room."""
-    room = get_room_by_code(code)
-    if not room:
-        raise HTTPException(404, "Room not found")
-    return get_notes_for_room(room["id"])
+    return await _cached_room_response(request, "notes", room, get_notes_by_code)
 
 
 @app.get("/rooms/{code}/comments")
-async def api_get_comments(code: str):
+async def api_get_comments(request: Request, room: dict = Depends(room_dep)):
     """Get all comments for a room."""
-    room = get_room_by_code(code)
-    if not room:
-        raise HTTPException(404, "Room not found")
-    return get_comments_for_room(room["id"])
+    return await _cached_room_response(request, "comments", room, get_comments_by_code)
+
+
+# How long plain highlight clicks are collected before being written together
+HIGHLIGHT_FLUSH_INTERVAL = float(os.getenv("HIGHLIGHT_FLUSH_INTERVAL", "0.05"))
+# A failed write is retried this many times, after 1s, 2s, 4s, ...
+HIGHLIGHT_FLUSH_RETRIES = 3
+HIGHLIGHT_RETRY_DELAY = 1.0
+
+
+class _HighlightBuffer:
+    """Coalesces plain highlight clicks into one batched write per interval.
+
+    Clicks are counted per (room_id, section_id); the first click after a
+    flush schedules the next one, so a burst of N clicks on a section costs
+    a single increment-by-N instead of N round-trips.  Clicks have already
+    been acknowledged, so a failed write is merged back and retried.
+    """
+
+    def __init__(self):
+        self.pending: dict[tuple[str, str], int] = {}
+        self.worker: asyncio.Task | None = None
+        self.failures = 0
+
+    def add(self, room_id: str, section_id: str) -> None:
+        key = (room_id, section_id)
+        self.pending[key] = self.pending.get(key, 0) + 1
+        if self.worker is None:
+            self.worker = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self, delay: float = HIGHLIGHT_FLUSH_INTERVAL) -> None:
+        await asyncio.sleep(delay)
+        self.worker = None
+        await self.flush()
+
+    async def flush(self, retry: bool = True) -> None:
+        if not self.pending:
+            return
+        batch, self.pending = self.pending, {}
+        try:
+            await add_highlights(batch)
+        except Exception as e:
+            self.failures += 1
+            if not retry or self.failures > HIGHLIGHT_FLUSH_RETRIES:
+                logger.error("Dropping %d highlights after %d failed writes: %s", sum(batch.values()), self.failures, e)
+                self.failures = 0
+                return
+            logger.warning("Failed to record %d highlights, retrying: %s", sum(batch.values()), e)
+            for key, count in batch.items():
+                self.pending[key] = self.pending.get(key, 0) + count
+            if self.worker is None:
+                delay = HIGHLIGHT_RETRY_DELAY * 2 ** (self.failures - 1)
+                self.worker = asyncio.create_task(self._flush_later(delay))
+            return
+        self.failures = 0
+        for room_id, _ in batch:
+            _invalidate_room_responses(room_id)
+
+    async def aclose(self) -> None:
+        """Write out anything still buffered (call on app shutdown)."""
+        if self.worker is not None:
+            self.worker.cancel()
+            self.worker = None
+        await self.flush(retry=False)
+
+
+_highlights = _HighlightBuffer()
 
 
 @app.post("/rooms/{code}/highlight")
 async def api_highlight(code: str, body: dict):
-    """Highlight a section and optionally add a comment."""
-    room = get_room_by_code(code)
-    if not room:
-        raise HTTPException(404, "Room not found")
+    """Highlight a section and optionally add a comment.
 
+    Plain highlights are acknowledged as soon as they're buffered and
+    written in batches; highlights with a comment are written immediately
+    and return the stored comment.
+    """
     section_id = body.get("section_id")
     comment = body.get("comment")
     highlighted_text = body.get("highlighted_text")
     if not section_id:
         raise HTTPException(400, "section_id is required")
 
-    count = increment_highlight(room["id"], section_id)
+    room = await _resolve_room(code)
+    if not room:
+        raise HTTPException(404, "Room not found")
+
+    if not comment:
+        _highlights.add(room["id"], section_id)
+        return {"ok": True}
 
-    if comment:
-        add_comment(room["id"], section_id, comment, highlighted_text)
+    # Room lookup, increment and comment insert in one database round-trip
+    result = await highlight_by_code(code, section_id, comment, highlighted_text)
+    if result is None:
+        raise HTTPException(404, "Room not found")
+    _invalidate_room_responses(room["id"])
+
+    response = {"section_id": section_id, "highlight_count": result["highlight_count"]}
+    if "comment" in result:
+        response["comment"] = result["comment"]
 
-    return {"section_id": section_id, "highlight_count": count}
+    return response
 
 
 # ---------------------------------------------------------------------------
 # Text-to-Speech endpoint (secure backend-only)
 # ---------------------------------------------------------------------------
 
-def _latex_to_spoken_text(text: str) -> str:
-    """Use the LLM to convert LaTeX-laden text into natural spoken text."""
-    import requests as _requests
+# Opt-in: send text the LaTeX rules can't fully handle to the LLM instead of
+# dropping the leftover markup (adds a multi-second round-trip for that text).
+LLM_TTS_REWRITE = os.getenv("LLM_TTS_REWRITE") == "1"
+
+
+async def _latex_to_spoken_text(text: str) -> str:
+    """Convert LaTeX-laden text into natural spoken text.
+
+    The rule-based pass handles typical notes instantly; with LLM_TTS_REWRITE
+    set, text with math it can't spell out is sent to the LLM instead.
+    """
+    spoken = latex_to_speech(text, strict=LLM_TTS_REWRITE)
+    if spoken is not None:
+        return spoken
 
     api_key = os.getenv("OPENROUTER_API_KEY")
     if not api_key:
@@ -281,7 +639,7 @@ def _latex_to_spoken_text(text: str) -> str:
     )
 
     try:
-        resp = _requests.post(
+        resp = await _http_client.post(
             "https://openrouter.ai/api/v1/chat/completions",
             headers={
                 "Authorization": f"Bearer {api_key}",
@@ -295,17 +653,44 @@ def _latex_to_spoken_text(text: str) -> str:
             timeout=15,
         )
         resp.raise_for_status()
-        return resp.json()["choices"][0]["message"]["content"].strip()
+        return orjson.loads(resp.content)["choices"][0]["message"]["content"].strip()
     except Exception as e:
         logger.error(f"LaTeX-to-speech LLM conversion failed: {e}")
         return text  # fall back to raw text
 
 
+# ElevenLabs settings; part of the TTS cache key, since they change the audio.
+TTS_MODEL_ID = "eleven_flash_v2_5"
+TTS_OUTPUT_FORMAT = "mp3_22050_32"
+# voice_id is interpolated into the ElevenLabs URL path, so only plain IDs pass
+_VOICE_ID_RE = re.compile(r"[A-Za-z0-9]{1,64}")
+
+# Public URLs of TTS audio known to be in storage, so repeat plays of a section
+# skip even the storage existence check.  LRU-bounded, since keys come from
+# client-supplied text.
+TTS_URL_CACHE_SIZE = 4096
+_tts_urls: OrderedDict[str, str] = OrderedDict()
+
+
+def _cache_tts_url(key: str, url: str) -> None:
+    _tts_urls[key] = url
+    _tts_urls.move_to_end(key)
+    if len(_tts_urls) > TTS_URL_CACHE_SIZE:
+        _tts_urls.popitem(last=False)
+
+
+def _tts_cache_key(spoken_text: str, voice_id: str) -> str:
+    key_source = "\0".join((voice_id, TTS_MODEL_ID, TTS_OUTPUT_FORMAT, spoken_text))
+    return hashlib.blake2b(key_source.encode(), digest_size=16).hexdigest()
+
+
 @app.post("/tts")
 async def text_to_speech(body: dict):
     """
     Convert text to speech using ElevenLabs.
-    Runs the text through an LLM first to convert LaTeX into speakable prose.
+    LaTeX is converted into speakable prose first (see _latex_to_spoken_text).
+    Audio already synthesised for the same text and voice is served from
+    Supabase Storage via a redirect.
     API key is kept secure on the backend.
     """
     text = body.get("text")
@@ -313,29 +698,78 @@ async def text_to_speech(body: dict):
 
     if not text:
         raise HTTPException(400, "text is required")
+    if not isinstance(voice_id, str) or not _VOICE_ID_RE.fullmatch(voice_id):
+        raise HTTPException(400, "invalid voice_id")
 
     try:
-        # 1. Convert LaTeX to natural spoken text via LLM
-        spoken_text = await asyncio.to_thread(_latex_to_spoken_text, text)
-        logger.info(f"Spoken text ({len(spoken_text)} chars): {spoken_text[:120]}...")
-
-        # 2. Generate speech with ElevenLabs (flash model for speed)
+        # 1. Convert LaTeX to natural spoken text
+        spoken_text = await _latex_to_spoken_text(text)
+        logger.info("Spoken text (%d chars): %.120s...", len(spoken_text), spoken_text)
+
+        # 2. Serve previously synthesised audio for the same text and voice
+        cache_key = _tts_cache_key(spoken_text, voice_id)
+        cached_url = _tts_urls.get(cache_key)
+        if cached_url is None:
+            try:
+                cached_url = await get_tts_audio_url(cache_key)
+            except Exception as e:
+                logger.warning(f"TTS cache lookup failed: {e}")
+        if cached_url is not None:
+            _cache_tts_url(cache_key, cached_url)
+            # 303 so the browser re-fetches the stored MP3 with a plain GET
+            return RedirectResponse(cached_url, status_code=303)
+
+        # 3. Generate speech with ElevenLabs (flash model for speed).  The
+        # streaming endpoint is called directly so MP3 chunks are relayed
+        # to the client as they are synthesised, never buffered here.
         api_key = os.getenv("ELEVENLABS_API_KEY")
         if not api_key:
             raise HTTPException(500, "ElevenLabs API key not configured")
 
-        elevenlabs = ElevenLabs(api_key=api_key)
-        audio = elevenlabs.text_to_speech.convert(
-            text=spoken_text,
-            voice_id=voice_id,
-            model_id="eleven_flash_v2_5",
-            output_format="mp3_22050_32",
+        request = _http_client.build_request(
+            "POST",
+            f"https://api.elevenlabs.io/v1/text-to-speech/{voice_id}/stream",
+            params={"output_format": TTS_OUTPUT_FORMAT},
+            headers={"xi-api-key": api_key},
+            json={"text": spoken_text, "model_id": TTS_MODEL_ID},
         )
+        resp = await _http_client.send(request, stream=True)
+        if resp.is_error:
+            detail = (await resp.aread())[:300].decode(errors="replace")
+            await resp.aclose()
+            logger.error("ElevenLabs responded %d: %s", resp.status_code, detail)
+            raise HTTPException(500, f"Failed to generate speech: ElevenLabs responded {resp.status_code}")
+
+        # Chunks are also kept so the finished audio can be stored for
+        # next time, once the response has been fully sent.
+        chunks: list[bytes] = []
+        complete = False
+
+        async def audio_chunks():
+            nonlocal complete
+            try:
+                async for chunk in resp.aiter_bytes(8192):
+                    chunks.append(chunk)
+                    yield chunk
+                complete = True
+            finally:
+                await resp.aclose()
+
+        async def store_audio():
+            if not complete:
+                return
+            try:
+                _cache_tts_url(cache_key, await upload_tts_audio(cache_key, b"".join(chunks)))
+            except Exception as e:
+                logger.warning(f"Failed to cache TTS audio: {e}")
 
         return StreamingResponse(
-            content=audio,
+            content=audio_chunks(),
             media_type="audio/mpeg",
-            headers={"Content-Disposition": "inline; filename=audio.mp3"}
+            # MP3 doesn't compress; "identity" also keeps GZipMiddleware from
+            # buffering the stream inside its compressor.
+            headers={"Content-Disposition": "inline; filename=audio.mp3", "Content-Encoding": "identity"},
+            background=BackgroundTask(store_audio),
         )
     except HTTPException:
         raise
@@ -19,7 +19,15 @@ if not dsn:
 print("Connecting to database...")
 conn = psycopg.connect(dsn, sslmode="require")
 
+# Arbitrary app-wide key for the migration advisory lock.
+MIGRATION_LOCK_KEY = 4242
+
 with conn.cursor() as cur:
+    # Serialise concurrent runs (e.g. two deploys starting at once).  The
+    # transaction-scoped lock also works behind Supabase's transaction pooler
+    # and is released automatically on commit/rollback.
+    cur.execute("SELECT pg_advisory_xact_lock(%s)", (MIGRATION_LOCK_KEY,))
+
     # --- Rooms ---
     cur.execute("""
         CREATE TABLE IF NOT EXISTS rooms (
@@ -102,23 +110,83 @@ with conn.cursor() as cur:
     """)
     print("  ✓ comments.highlighted_text column")
 
+    # --- Index: comments are always read per room in creation order ---
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS idx_comments_room_created
+        ON comments (room_id, created_at);
+    """)
+    print("  ✓ comments (room_id, created_at) index")
+
+    # --- Index: notes are read per room in id order (the section summary on
+    # every capture, and the notes list).  UNIQUE(room_id, section_id) already
+    # serves plain room_id lookups, and UNIQUE(code) serves room lookups. ---
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS idx_lecture_notes_room_id
+        ON lecture_notes (room_id, id);
+    """)
+    print("  ✓ lecture_notes (room_id, id) index")
+
     # --- RPC: increment highlight count atomically ---
     cur.execute("""
         CREATE OR REPLACE FUNCTION increment_highlight(p_room_id UUID, p_section_id TEXT)
         RETURNS INT AS $$
-        DECLARE
-            new_count INT;
-        BEGIN
             INSERT INTO highlights (room_id, section_id, highlight_count)
             VALUES (p_room_id, p_section_id, 1)
             ON CONFLICT (room_id, section_id)
             DO UPDATE SET highlight_count = highlights.highlight_count + 1
-            RETURNING highlight_count INTO new_count;
-            RETURN new_count;
+            RETURNING highlight_count;
+        $$ LANGUAGE sql;
+    """)
+    print("  ✓ increment_highlight function")
+
+    # --- RPC: resolve a room code, highlight and comment in one call ---
+    cur.execute("""
+        CREATE OR REPLACE FUNCTION highlight_by_code(
+            p_code TEXT,
+            p_section_id TEXT,
+            p_comment TEXT DEFAULT NULL,
+            p_highlighted_text TEXT DEFAULT NULL
+        )
+        RETURNS JSONB AS $$
+        DECLARE
+            v_room_id UUID;
+            v_count INT;
+            v_comment comments;
+        BEGIN
+            SELECT id INTO v_room_id FROM rooms WHERE code = p_code AND is_active;
+            IF v_room_id IS NULL THEN
+                RETURN NULL;
+            END IF;
+
+            v_count := increment_highlight(v_room_id, p_section_id);
+            IF p_comment IS NULL THEN
+                RETURN jsonb_build_object('highlight_count', v_count);
+            END IF;
+
+            INSERT INTO comments (room_id, section_id, comment, highlighted_text)
+            VALUES (v_room_id, p_section_id, p_comment, p_highlighted_text)
+            RETURNING * INTO v_comment;
+            RETURN jsonb_build_object('highlight_count', v_count, 'comment', to_jsonb(v_comment));
         END;
         $$ LANGUAGE plpgsql;
     """)
-    print("  ✓ increment_highlight function")
+    print("  ✓ highlight_by_code function")
+
+    # --- RPC: apply a batch of buffered highlight clicks in one statement ---
+    cur.execute("""
+        CREATE OR REPLACE FUNCTION add_highlights(p_items JSONB)
+        RETURNS VOID AS $$
+            INSERT INTO highlights (room_id, section_id, highlight_count)
+            SELECT i.room_id, i.section_id, i.count
+            FROM jsonb_to_recordset(p_items) AS i(room_id UUID, section_id TEXT, count INT)
+            -- Rooms deleted since their clicks were buffered are skipped, so
+            -- they can't fail the rest of the batch on the foreign key
+            JOIN rooms r ON r.id = i.room_id
+            ON CONFLICT (room_id, section_id)
+            DO UPDATE SET highlight_count = highlights.highlight_count + EXCLUDED.highlight_count;
+        $$ LANGUAGE sql;
+    """)
+    print("  ✓ add_highlights function")
 
     # --- Enable RLS + read policies for client access (professor_key never exposed) ---
     cur.execute("""
@@ -179,14 +247,21 @@ with conn.cursor() as cur:
     """)
     print("  ✓ RLS enabled with read policies for clients")
 
-    # --- Enable Supabase Realtime on tables ---
+    # --- Enable Supabase Realtime on tables (skipping ones already added, so
+    # the migration stays one transaction that is never rolled back) ---
     for table in ["lecture_notes", "highlights", "comments"]:
-        try:
-            cur.execute(f"ALTER PUBLICATION supabase_realtime ADD TABLE {table};")
-        except Exception:
-            # Already added — ignore
-            conn.rollback()
-            conn.autocommit = False
+        cur.execute(f"""
+            DO $$
+            BEGIN
+                IF NOT EXISTS (
+                    SELECT 1 FROM pg_publication_tables
+                    WHERE pubname = 'supabase_realtime'
+                      AND schemaname = 'public' AND tablename = '{table}'
+                ) THEN
+                    ALTER PUBLICATION supabase_realtime ADD TABLE public.{table};
+                END IF;
+            END $$;
+        """)
     print("  ✓ Realtime enabled")
 
 conn.commit()
@@ -1,272 +1,355 @@
-"""Supabase client for all database operations."""
+"""Database (direct Postgres) and Supabase Storage operations."""
 
 import os
-import random
+import base64
+import asyncio
 import secrets
-import string
 import logging
 
-from supabase import create_client, Client
+import asyncpg
+import httpx
+import orjson
+from supabase import acreate_client, AsyncClient, AsyncClientOptions
 
 logger = logging.getLogger(__name__)
 
-_supabase: Client | None = None
-
-
-def get_client() -> Client:
-    global _supabase
+# Table reads and writes go straight to Postgres over one asyncpg pool
+# (DATABASE_URL, normally the Supabase pooler), skipping PostgREST's extra
+# HTTPS hop.  The Supabase client below is kept for Storage only.
+DATABASE_MAX_CONNECTIONS = int(os.getenv("DATABASE_MAX_CONNECTIONS", "10"))
+# Per-connection cache of prepared statements, keyed by SQL text (the
+# module-level _SQL_* constants below).  Off by default: the transaction
+# pooler can't keep named prepared statements across transactions.  Raise
+# it when DATABASE_URL is a session-pooler or direct connection.
+DATABASE_STATEMENT_CACHE_SIZE = int(os.getenv("DATABASE_STATEMENT_CACHE_SIZE", "0"))
+_pool: asyncpg.Pool | None = None
+_pool_lock = asyncio.Lock()
+
+# One async client (and its pooled HTTP connections) shared by every request;
+# handlers await these calls directly instead of parking a worker thread.
+_supabase: AsyncClient | None = None
+_client_lock = asyncio.Lock()
+
+# Connection pool behind Storage.  Bounded so a burst of uploads can't open
+# unlimited sockets to the project; idle connections are recycled before
+# proxies/NATs silently drop them.
+SUPABASE_MAX_CONNECTIONS = int(os.getenv("SUPABASE_MAX_CONNECTIONS", "10"))
+SUPABASE_TIMEOUT = float(os.getenv("SUPABASE_TIMEOUT", "30"))
+_http: httpx.AsyncClient | None = None
+
+
+async def _init_connection(conn: asyncpg.Connection) -> None:
+    """Decode UUIDs as str and JSON(B) via orjson, matching the old REST payloads."""
+    await conn.set_type_codec("uuid", encoder=str, decoder=str, schema="pg_catalog")
+    for typename in ("json", "jsonb"):
+        await conn.set_type_codec(
+            typename,
+            encoder=lambda value: orjson.dumps(value).decode(),
+            decoder=orjson.loads,
+            schema="pg_catalog",
+        )
+
+
+async def get_pool() -> asyncpg.Pool:
+    global _pool
+    if _pool is None:
+        async with _pool_lock:
+            if _pool is None:
+                dsn = os.getenv("DATABASE_URL")
+                if not dsn:
+                    raise ValueError("DATABASE_URL must be set in .env")
+                _pool = await asyncpg.create_pool(
+                    dsn,
+                    min_size=min(2, DATABASE_MAX_CONNECTIONS),
+                    max_size=DATABASE_MAX_CONNECTIONS,
+                    ssl="require",
+                    statement_cache_size=DATABASE_STATEMENT_CACHE_SIZE,
+                    init=_init_connection,
+                )
+    return _pool
+
+
+async def get_client() -> AsyncClient:
+    global _supabase, _http
     if _supabase is None:
-        url = os.getenv("SUPABASE_URL")
-        key = os.getenv("SUPABASE_KEY")
-        if not url or not key:
-            raise ValueError("SUPABASE_URL and SUPABASE_KEY must be set in .env")
-        _supabase = create_client(url, key)
+        async with _client_lock:
+            if _supabase is None:
+                url = os.getenv("SUPABASE_URL")
+                key = os.getenv("SUPABASE_KEY")
+                if not url or not key:
+                    raise ValueError("SUPABASE_URL and SUPABASE_KEY must be set in .env")
+                _http = httpx.AsyncClient(
+                    http2=True,
+                    timeout=httpx.Timeout(SUPABASE_TIMEOUT, connect=5.0),
+                    limits=httpx.Limits(
+                        max_connections=SUPABASE_MAX_CONNECTIONS,
+                        max_keepalive_connections=SUPABASE_MAX_CONNECTIONS,
+                        keepalive_expiry=60.0,
+                    ),
+                )
+                _supabase = await acreate_client(
+                    url, key, options=AsyncClientOptions(httpx_client=_http)
+                )
     return _supabase
 
 
+async def aclose() -> None:
+    """Close the database pool and Supabase HTTP connections (call on app shutdown)."""
+    global _pool, _supabase, _http
+    if _pool is not None:
+        await _pool.close()
+    if _http is not None:
+        await _http.aclose()
+    _pool = _supabase = _http = None
+
+
 # ---------------------------------------------------------------------------
 # Rooms
 # ---------------------------------------------------------------------------
 
 def _generate_code(length: int = 6) -> str:
-    """Generate a random room code like 'X3KQ7P'."""
-    chars = string.ascii_uppercase + string.digits
-    return "".join(random.choices(chars, k=length))
+    """Generate a random room code like 'X3KQ7P' (base32: A-Z, 2-7)."""
+    return base64.b32encode(os.urandom((length * 5 + 7) // 8)).decode()[:length]
+
+
+_SQL_CREATE_ROOM = "INSERT INTO rooms (code, professor_key, name) VALUES ($1, $2, $3) RETURNING *"
 
 
-def create_room(name: str | None = None) -> dict:
+async def create_room(name: str | None = None) -> dict:
     """Create a new room and return it (including the professor_key)."""
-    sb = get_client()
-    code = _generate_code()
-    professor_key = secrets.token_urlsafe(16)
-    row = {"code": code, "professor_key": professor_key}
-    if name:
-        row["name"] = name
-    result = sb.table("rooms").insert(row).execute()
-    return result.data[0]
+    pool = await get_pool()
+    row = await pool.fetchrow(
+        _SQL_CREATE_ROOM,
+        _generate_code(),
+        secrets.token_urlsafe(16),
+        name or None,
+    )
+    return dict(row)
+
+
+_SQL_GET_ROOM_BY_CODE = "SELECT * FROM rooms WHERE code = $1 AND is_active"
 
 
-def get_room_by_code(code: str) -> dict | None:
+async def get_room_by_code(code: str) -> dict | None:
     """Look up a room by its join code."""
-    sb = get_client()
-    result = sb.table("rooms").select("*").eq("code", code.upper()).eq("is_active", True).execute()
-    return result.data[0] if result.data else None
+    pool = await get_pool()
+    row = await pool.fetchrow(_SQL_GET_ROOM_BY_CODE, code.upper())
+    return dict(row) if row else None
 
 
-def get_all_rooms() -> list[dict]:
-    """Return all active rooms with their note counts."""
-    sb = get_client()
-    rooms_result = (
-        sb.table("rooms")
-        .select("id, code, name, created_at")
-        .eq("is_active", True)
-        .order("created_at", desc=True)
-        .execute()
-    )
-    if not rooms_result.data:
-        return []
-
-    # Fetch note counts per room in bulk
-    room_ids = [r["id"] for r in rooms_result.data]
-    notes_result = (
-        sb.table("lecture_notes")
-        .select("room_id")
-        .in_("room_id", room_ids)
-        .execute()
-    )
+_SQL_GET_ALL_ROOMS = """
+    SELECT r.id, r.code, r.name, r.created_at,
+           (SELECT count(*) FROM lecture_notes n WHERE n.room_id = r.id) AS note_count
+    FROM rooms r
+    WHERE r.is_active
+    ORDER BY r.created_at DESC
+"""
 
-    # Count notes per room
-    note_counts: dict[str, int] = {}
-    for row in notes_result.data:
-        rid = row["room_id"]
-        note_counts[rid] = note_counts.get(rid, 0) + 1
-
-    rooms = []
-    for r in rooms_result.data:
-        rooms.append({
-            "id": r["id"],
-            "code": r["code"],
-            "name": r.get("name"),
-            "created_at": r["created_at"],
-            "note_count": note_counts.get(r["id"], 0),
-        })
-    return rooms
-
-
-def verify_professor_key(code: str, key: str) -> bool:
-    """Check whether the provided key matches the room's professor_key."""
-    sb = get_client()
-    result = (
-        sb.table("rooms")
-        .select("professor_key")
-        .eq("code", code.upper())
-        .eq("is_active", True)
-        .execute()
-    )
-    if not result.data:
-        return False
-    return result.data[0].get("professor_key") == key
+
+async def get_all_rooms() -> list[dict]:
+    """Return all active rooms with their note counts."""
+    pool = await get_pool()
+    # The note count is aggregated server-side; no per-note rows are fetched.
+    rows = await pool.fetch(_SQL_GET_ALL_ROOMS)
+    return [dict(r) for r in rows]
 
 
 # ---------------------------------------------------------------------------
 # Lecture Notes
 # ---------------------------------------------------------------------------
 
-def upsert_notes(room_id: str, sections: list[dict]) -> None:
-    """Upsert lecture note sections for a room."""
-    sb = get_client()
-    rows = [
-        {
-            "room_id": room_id,
-            "section_id": s["section_id"],
-            "type": s["type"],
-            "content": s["content"],
-            "caption": s.get("caption"),
-            "image_url": s.get("image_url"),
-        }
-        for s in sections
-    ]
-    sb.table("lecture_notes").upsert(rows, on_conflict="room_id,section_id").execute()
+_SQL_UPSERT_NOTES = """
+    INSERT INTO lecture_notes (room_id, section_id, type, content, caption, image_url)
+    SELECT $1::uuid, * FROM unnest($2::text[], $3::text[], $4::text[], $5::text[], $6::text[])
+    ON CONFLICT (room_id, section_id) DO UPDATE SET
+        type = EXCLUDED.type,
+        content = EXCLUDED.content,
+        caption = EXCLUDED.caption,
+        image_url = EXCLUDED.image_url
+    WHERE (lecture_notes.type, lecture_notes.content, lecture_notes.caption, lecture_notes.image_url)
+        IS DISTINCT FROM (EXCLUDED.type, EXCLUDED.content, EXCLUDED.caption, EXCLUDED.image_url)
+    RETURNING *
+"""
+
+
+async def upsert_notes(room_id: str, sections: list[dict]) -> list[dict]:
+    """Upsert lecture note sections for a room and return the rows that changed.
+
+    Sections identical to what's stored are skipped entirely: no row
+    rewrite, and no Realtime event for clients to refetch on.
+    """
+    pool = await get_pool()
+    # All sections go in one statement, as parallel arrays unnested server-side.
+    rows = await pool.fetch(
+        _SQL_UPSERT_NOTES,
+        room_id,
+        [s["section_id"] for s in sections],
+        [s["type"] for s in sections],
+        [s["content"] for s in sections],
+        [s.get("caption") for s in sections],
+        [s.get("image_url") for s in sections],
+    )
+    return [dict(r) for r in rows]
 
 
-def delete_notes(room_id: str, section_ids: list[str]) -> None:
+_SQL_DELETE_NOTES = "DELETE FROM lecture_notes WHERE room_id = $1 AND section_id = ANY($2::text[])"
+
+
+async def delete_notes(room_id: str, section_ids: list[str]) -> None:
     """Delete specific lecture note sections by their section_ids."""
     if not section_ids:
         return
-    sb = get_client()
-    sb.table("lecture_notes").delete().eq("room_id", room_id).in_("section_id", section_ids).execute()
-    logger.info(f"Deleted orphaned sections: {section_ids}")
-
-
-def get_existing_section_ids(room_id: str) -> list[str]:
-    """Return all section_ids that already exist for a room."""
-    sb = get_client()
-    result = (
-        sb.table("lecture_notes")
-        .select("section_id")
-        .eq("room_id", room_id)
-        .order("id")
-        .execute()
-    )
-    return [row["section_id"] for row in result.data]
+    pool = await get_pool()
+    await pool.execute(_SQL_DELETE_NOTES, room_id, section_ids)
+    logger.info("Deleted orphaned sections: %s", section_ids)
+
+
+_SQL_GET_SECTIONS_SUMMARY = """
+    SELECT section_id, type, coalesce(left(content, 150), '') AS content_preview, image_url
+    FROM lecture_notes
+    WHERE room_id = $1
+    ORDER BY id
+"""
 
 
-def get_existing_sections_summary(room_id: str) -> list[dict]:
+async def get_existing_sections_summary(room_id: str) -> list[dict]:
     """Return section_id, type, content snippet, and image_url for each existing section."""
-    sb = get_client()
-    result = (
-        sb.table("lecture_notes")
-        .select("section_id, type, content, image_url")
-        .eq("room_id", room_id)
-        .order("id")
-        .execute()
-    )
-    return [
-        {
-            "section_id": row["section_id"],
-            "type": row["type"],
-            "content_preview": (row.get("content") or "")[:150],
-            "image_url": row.get("image_url"),
-        }
-        for row in result.data
-    ]
+    pool = await get_pool()
+    # Only the preview leaves the database, not each section's full content.
+    rows = await pool.fetch(_SQL_GET_SECTIONS_SUMMARY, room_id)
+    return [dict(r) for r in rows]
 
 
-def get_notes_for_room(room_id: str) -> list[dict]:
-    """Get all notes for a room with highlight counts."""
-    sb = get_client()
+_SQL_GET_NOTES_BY_CODE = """
+    SELECT n.id, n.section_id, n.type, n.content, n.caption, n.image_url,
+           coalesce(h.highlight_count, 0) AS highlight_count, n.created_at
+    FROM rooms r
+    LEFT JOIN lecture_notes n ON n.room_id = r.id
+    LEFT JOIN highlights h ON h.room_id = n.room_id AND h.section_id = n.section_id
+    WHERE r.code = $1 AND r.is_active
+    ORDER BY n.id
+"""
 
-    # Fetch notes and highlights separately (no FK between tables)
-    notes_result = (
-        sb.table("lecture_notes")
-        .select("*")
-        .eq("room_id", room_id)
-        .order("id")
-        .execute()
-    )
-    highlights_result = (
-        sb.table("highlights")
-        .select("section_id, highlight_count")
-        .eq("room_id", room_id)
-        .execute()
-    )
 
-    # Build a lookup map: section_id -> highlight_count
-    hl_map = {
-        row["section_id"]: row.get("highlight_count", 0)
-        for row in highlights_result.data
-    }
-
-    notes = []
-    for row in notes_result.data:
-        notes.append({
-            "id": row["id"],
-            "section_id": row["section_id"],
-            "type": row["type"],
-            "content": row["content"],
-            "caption": row.get("caption"),
-            "image_url": row.get("image_url"),
-            "highlight_count": hl_map.get(row["section_id"], 0),
-            "created_at": row.get("created_at"),
-        })
-    return notes
+async def get_notes_by_code(code: str) -> list[dict] | None:
+    """Get all notes for the active room `code`, with highlight counts.
+
+    The room lookup, notes and highlights are joined in one query.
+    Returns None if there is no such room.
+    """
+    pool = await get_pool()
+    rows = await pool.fetch(_SQL_GET_NOTES_BY_CODE, code.upper())
+    if not rows:
+        return None
+    # A room without notes still yields its one all-NULL joined row
+    return [dict(r) for r in rows if r["id"] is not None]
 
 
 # ---------------------------------------------------------------------------
 # Highlights & Comments
 # ---------------------------------------------------------------------------
 
-def increment_highlight(room_id: str, section_id: str) -> int:
-    """Atomically increment highlight count via the database function."""
-    sb = get_client()
-    result = sb.rpc("increment_highlight", {
-        "p_room_id": room_id,
-        "p_section_id": section_id,
-    }).execute()
-    return result.data if isinstance(result.data, int) else 1
-
-
-def add_comment(room_id: str, section_id: str, comment: str, highlighted_text: str | None = None) -> None:
-    """Add a student comment/question, optionally with the highlighted text snippet."""
-    sb = get_client()
-    row = {
-        "room_id": room_id,
-        "section_id": section_id,
-        "comment": comment,
-    }
-    if highlighted_text:
-        row["highlighted_text"] = highlighted_text
-    sb.table("comments").insert(row).execute()
-
-
-def get_comments_for_room(room_id: str) -> list[dict]:
-    """Get all comments for a room."""
-    sb = get_client()
-    result = (
-        sb.table("comments")
-        .select("*")
-        .eq("room_id", room_id)
-        .order("created_at")
-        .execute()
+_SQL_HIGHLIGHT_BY_CODE = "SELECT highlight_by_code($1, $2, $3, $4)"
+
+
+async def highlight_by_code(
+    code: str, section_id: str, comment: str | None = None, highlighted_text: str | None = None
+) -> dict | None:
+    """Highlight a section of room `code` and optionally add a comment.
+
+    Runs server-side in one transaction via the highlight_by_code database
+    function.  Returns {"highlight_count": int, "comment": row} (comment only
+    when one was added), or None if there is no such active room.
+    """
+    pool = await get_pool()
+    return await pool.fetchval(
+        _SQL_HIGHLIGHT_BY_CODE,
+        code.upper(),
+        section_id,
+        comment or None,
+        highlighted_text or None,
     )
-    return result.data
+
+
+_SQL_ADD_HIGHLIGHTS = "SELECT add_highlights($1)"
+
+
+async def add_highlights(counts: dict[tuple[str, str], int]) -> None:
+    """Add batched highlight clicks, keyed by (room_id, section_id), in one call."""
+    pool = await get_pool()
+    items = [
+        {"room_id": room_id, "section_id": section_id, "count": count}
+        for (room_id, section_id), count in counts.items()
+    ]
+    await pool.execute(_SQL_ADD_HIGHLIGHTS, items)
+
+
+_SQL_GET_COMMENTS_BY_CODE = """
+    SELECT c.*
+    FROM rooms r
+    LEFT JOIN comments c ON c.room_id = r.id
+    WHERE r.code = $1 AND r.is_active
+    ORDER BY c.created_at
+"""
+
+
+async def get_comments_by_code(code: str) -> list[dict] | None:
+    """Get all comments for the active room `code`, oldest first.
+
+    Joined to the room lookup in one query; None if there is no such room.
+    """
+    pool = await get_pool()
+    rows = await pool.fetch(_SQL_GET_COMMENTS_BY_CODE, code.upper())
+    if not rows:
+        return None
+    return [dict(r) for r in rows if r["id"] is not None]
 
 
 # ---------------------------------------------------------------------------
-# Storage (diagram images)
+# Storage (diagram images, cached TTS audio)
 # ---------------------------------------------------------------------------
 
 DIAGRAMS_BUCKET = "diagrams"
 
 
-def upload_diagram(filename: str, image_bytes: bytes, content_type: str = "image/png") -> str:
-    """Upload a diagram image to Supabase Storage and return its public URL."""
-    sb = get_client()
-    sb.storage.from_(DIAGRAMS_BUCKET).upload(
+async def upload_diagram(filename: str, image_bytes: bytes, content_type: str = "image/png") -> str:
+    """Upload a diagram image to Supabase Storage and return its public URL.
+
+    Filenames are content-addressed, so an object already stored under
+    `filename` is reused as-is.
+    """
+    sb = await get_client()
+    bucket = sb.storage.from_(DIAGRAMS_BUCKET)
+    if await bucket.exists(filename):
+        return await bucket.get_public_url(filename)
+    await bucket.upload(
         filename,
         image_bytes,
-        {"content-type": content_type},
+        {"content-type": content_type, "upsert": "true"},
     )
-    public_url = sb.storage.from_(DIAGRAMS_BUCKET).get_public_url(filename)
-    logger.info(f"Uploaded diagram to Supabase Storage: {public_url}")
+    public_url = await bucket.get_public_url(filename)
+    logger.info("Uploaded diagram to Supabase Storage: %s", public_url)
     return public_url
+
+
+# Synthesised speech lives in the same public bucket, keyed by content hash.
+TTS_PREFIX = "tts"
+
+
+async def get_tts_audio_url(key: str) -> str | None:
+    """Return the public URL of cached TTS audio for `key`, or None if absent."""
+    sb = await get_client()
+    bucket = sb.storage.from_(DIAGRAMS_BUCKET)
+    path = f"{TTS_PREFIX}/{key}.mp3"
+    if not await bucket.exists(path):
+        return None
+    return await bucket.get_public_url(path)
+
+
+async def upload_tts_audio(key: str, audio: bytes) -> str:
+    """Store synthesised TTS audio under `key` and return its public URL."""
+    sb = await get_client()
+    bucket = sb.storage.from_(DIAGRAMS_BUCKET)
+    path = f"{TTS_PREFIX}/{key}.mp3"
+    await bucket.upload(path, audio, {"content-type": "audio/mpeg", "upsert": "true"})
+    return await bucket.get_public_url(path)
@@ -1,15 +0,0 @@
-from dotenv import load_dotenv
-from elevenlabs.client import ElevenLabs
-from elevenlabs.play import play
-import os
-load_dotenv()
-elevenlabs = ElevenLabs(
-  api_key=os.getenv("ELEVENLABS_API_KEY"),
-)
-audio = elevenlabs.text_to_speech.convert(
-    text="Addition in R[x] is defined by f + g",
-    voice_id="JBFqnCBsd6RMkjVDRZzb",
-    model_id="eleven_multilingual_v2",
-    output_format="mp3_44100_128",
-)
-play(audio)
\ No newline at end of file
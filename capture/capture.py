@@ -13,15 +13,23 @@ Usage:
 import io
 import json
 import os
+import queue
 import sys
+import threading
 import time
 from datetime import datetime
 
 import requests
-from PIL import Image
+from requests.adapters import HTTPAdapter
 
 CONFIG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "config.json")
 
+# One keep-alive session for the camera and the backend, so each capture
+# reuses their connections instead of reconnecting every interval.
+session = requests.Session()
+for _prefix in ("http://", "https://"):
+    session.mount(_prefix, HTTPAdapter(pool_connections=2, pool_maxsize=4))
+
 
 def load_config():
     if not os.path.isfile(CONFIG_PATH):
@@ -41,38 +49,47 @@ def load_config():
     return config
 
 
-def grab_frame_mjpeg(stream, num_frames=10):
-    """Read multiple JPEG frames from an MJPEG stream, return the last complete one.
+def grab_frame_mjpeg(chunks, num_frames=10):
+    """Read multiple JPEG frames from MJPEG byte chunks, return the last complete one.
 
     The first frame is often partial/blurry. Reading several frames and keeping
     the last gives a much sharper result (matches what a browser displays).
     """
-    buf = b""
+    buf = bytearray()  # grown in place; consumed bytes are deleted from the front
+    start = -1  # offset of the current frame's SOI marker in buf, if seen
+    scan = 0  # where the next marker search resumes; earlier bytes are done
     last_frame = None
     frames_read = 0
 
-    while frames_read < num_frames:
-        chunk = stream.read(4096)
-        if not chunk:
-            break
-        buf += chunk
+    for chunk in chunks:
+        buf.extend(chunk)
 
         while True:
-            start = buf.find(b"\xff\xd8")
             if start == -1:
-                buf = b""
-                break
-            end = buf.find(b"\xff\xd9", start + 2)
+                start = buf.find(b"\xff\xd8", scan)
+                if start == -1:
+                    # Keep only a trailing byte that may begin a split marker
+                    del buf[:-1]
+                    scan = 0
+                    break
+                scan = start + 2
+            end = buf.find(b"\xff\xd9", scan)
             if end == -1:
                 # Keep from start marker onward, discard earlier bytes
-                buf = buf[start:]
+                if start:
+                    del buf[:start]
+                    start = 0
+                scan = max(2, len(buf) - 1)
                 break
             # Complete frame found
-            last_frame = buf[start : end + 2]
+            with memoryview(buf) as view:
+                last_frame = bytes(view[start : end + 2])
             frames_read += 1
-            buf = buf[end + 2:]
+            del buf[: end + 2]
+            start = -1
+            scan = 0
             if frames_read >= num_frames:
-                break
+                return last_frame
 
     return last_frame
 
@@ -80,29 +97,56 @@ def grab_frame_mjpeg(stream, num_frames=10):
 def grab_snapshot(camera_url, auth=None):
     """Grab a single frame - tries MJPEG stream and reads one frame."""
     try:
-        resp = requests.get(camera_url, stream=True, timeout=10, auth=auth)
-        resp.raise_for_status()
-        content_type = resp.headers.get("content-type", "")
-
-        if "multipart" in content_type:
-            frame = grab_frame_mjpeg(resp.raw)
-            resp.close()
-            return frame
-        elif "image" in content_type:
-            data = resp.content
-            resp.close()
-            return data
-        else:
-            frame = grab_frame_mjpeg(resp.raw)
-            resp.close()
-            return frame
+        # The with block closes the response even if reading it fails
+        with session.get(camera_url, stream=True, timeout=10, auth=auth) as resp:
+            resp.raise_for_status()
+            if "image" in resp.headers.get("content-type", ""):
+                return resp.content
+            # multipart (or unknown): parse it as an MJPEG stream
+            return grab_frame_mjpeg(resp.iter_content(chunk_size=4096))
     except requests.RequestException as e:
         print(f"Camera error: {e}")
         return None
 
 
+# APP1 segment holding a minimal big-endian Exif block with one tag,
+# Orientation = 6 ("rotate 90 degrees clockwise to display").
+_EXIF_ROTATE_CW = (
+    b"\xff\xe1\x00\x22Exif\x00\x00"
+    b"MM\x00\x2a\x00\x00\x00\x08"  # TIFF header, IFD0 at offset 8
+    b"\x00\x01"  # one IFD entry
+    b"\x01\x12\x00\x03\x00\x00\x00\x01\x00\x06\x00\x00"  # Orientation, SHORT, 1, 6
+    b"\x00\x00\x00\x00"  # no next IFD
+)
+
+
+def _has_exif(jpeg_bytes):
+    """True if the JPEG header (before the image data) has an Exif APP1 segment."""
+    pos = 2
+    while pos + 4 <= len(jpeg_bytes) and jpeg_bytes[pos] == 0xFF:
+        marker = jpeg_bytes[pos + 1]
+        if marker == 0xDA:  # start of scan: no more header segments
+            break
+        length = int.from_bytes(jpeg_bytes[pos + 2 : pos + 4], "big")
+        if marker == 0xE1 and jpeg_bytes[pos + 4 : pos + 10] == b"Exif\x00\x00":
+            return True
+        pos += 2 + length
+    return False
+
+
 def rotate_image(jpeg_bytes):
-    """Rotate image 90 degrees clockwise."""
+    """Rotate image 90 degrees clockwise.
+
+    Camera frames normally carry no Exif, so the rotation is recorded as an
+    Exif orientation tag: no decode, no re-encode, no quality loss.  Frames
+    that already have Exif are rotated in pixels instead.
+    """
+    if jpeg_bytes[:2] == b"\xff\xd8" and not _has_exif(jpeg_bytes):
+        return jpeg_bytes[:2] + _EXIF_ROTATE_CW + jpeg_bytes[2:]
+
+    # Only this fallback needs Pillow, so it isn't imported at startup
+    from PIL import Image
+
     img = Image.open(io.BytesIO(jpeg_bytes))
     rotated = img.rotate(-90, expand=True)
     buf = io.BytesIO()
@@ -110,11 +154,36 @@ def rotate_image(jpeg_bytes):
     return buf.getvalue()
 
 
+def frame_thumbnail(jpeg_bytes, size=(160, 120)):
+    """Small grayscale copy of a frame for change detection; None if undecodable."""
+    from PIL import Image
+
+    try:
+        img = Image.open(io.BytesIO(jpeg_bytes))
+        img.draft("L", size)  # JPEG: decode at reduced scale
+        return img.convert("L").resize(size, Image.BILINEAR)
+    except Exception as e:
+        print(f"Could not decode frame: {e}")
+        return None
+
+
+def changed_pixels(thumb_a, thumb_b, level=24):
+    """Count thumbnail pixels whose brightness differs by more than `level`.
+
+    Re-encoding and sensor noise stay under the level, while a few new
+    chalk strokes already change several pixels at this scale.
+    """
+    from PIL import ImageChops
+
+    diff = ImageChops.difference(thumb_a, thumb_b)
+    return sum(diff.histogram()[level + 1 :])
+
+
 def send_frame(backend_url, jpeg_bytes):
-    url = f"{backend_url.rstrip('/')}/upload-image"
+    # Raw JPEG body: no multipart encoding or extra copy of the frame
+    url = f"{backend_url.rstrip('/')}/upload-image-raw"
     try:
-        files = {"file": ("frame.jpg", io.BytesIO(jpeg_bytes), "image/jpeg")}
-        resp = requests.post(url, files=files, timeout=60)
+        resp = session.post(url, data=jpeg_bytes, headers={"Content-Type": "image/jpeg"}, timeout=60)
         print(f"[{resp.status_code}] {resp.text[:200]}")
         return resp
     except requests.ConnectionError:
@@ -126,6 +195,30 @@ def send_frame(backend_url, jpeg_bytes):
     return None
 
 
+def save_frame(filepath, jpeg_bytes):
+    with open(filepath, "wb") as f:
+        f.write(jpeg_bytes)
+    print(f"Saved: {filepath}")
+
+
+def start_worker(handle, maxsize):
+    """Run handle(*item) for each item put on the returned queue, in a daemon thread."""
+    jobs = queue.Queue(maxsize=maxsize)
+
+    def run():
+        while True:
+            item = jobs.get()
+            try:
+                handle(*item)
+            except Exception as e:
+                print(f"{handle.__name__} failed: {e}")
+            finally:
+                jobs.task_done()
+
+    threading.Thread(target=run, name=handle.__name__, daemon=True).start()
+    return jobs
+
+
 def main():
     config = load_config()
 
@@ -135,6 +228,8 @@ def main():
     username = config.get("camera_username")
     password = config.get("camera_password")
     auth = (username, password) if username else None
+    # Frames differing from the last one sent in fewer thumbnail pixels are skipped (0 = send all)
+    min_changed = config.get("min_changed_pixels", 4)
     print(f"Camera URL:  {camera_url}")
     print(f"Backend URL: {backend_url}")
     print(f"Interval:    {interval}s")
@@ -156,6 +251,13 @@ def main():
 
     print("Press Ctrl+C to stop.\n")
 
+    last_sent_thumb = None
+
+    # Disk writes and backend uploads run on their own threads so neither
+    # slow storage nor a slow backend delays the next capture.
+    save_queue = start_worker(save_frame, maxsize=16)
+    send_queue = start_worker(send_frame, maxsize=1)
+
     try:
         while True:
             jpeg = grab_snapshot(camera_url, auth=auth)
@@ -164,21 +266,42 @@ def main():
                 time.sleep(3)
                 continue
 
+            # Nothing new on the board: don't save, upload or process it again
+            thumb = frame_thumbnail(jpeg) if min_changed else None
+            if (
+                thumb is not None
+                and last_sent_thumb is not None
+                and changed_pixels(thumb, last_sent_thumb) < min_changed
+            ):
+                print("Board unchanged, skipping frame")
+                time.sleep(interval)
+                continue
+            last_sent_thumb = thumb
+
             # Rotate 90 degrees clockwise
             jpeg = rotate_image(jpeg)
 
             # Save frame locally
             timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
             filepath = os.path.join(captures_dir, f"frame_{timestamp}.jpg")
-            with open(filepath, "wb") as f:
-                f.write(jpeg)
-            print(f"Saved: {filepath}")
+            try:
+                save_queue.put_nowait((filepath, jpeg))
+            except queue.Full:
+                print(f"Disk writes falling behind, not saving {filepath}")
 
             print(f"Captured frame ({len(jpeg)} bytes), sending to backend...")
-            send_frame(backend_url, jpeg)
+            # Only the newest frame is worth sending: replace one still waiting
+            try:
+                send_queue.get_nowait()
+                send_queue.task_done()
+                print("Previous frame not sent yet, replacing it")
+            except queue.Empty:
+                pass
+            send_queue.put_nowait((backend_url, jpeg))
             time.sleep(interval)
     except KeyboardInterrupt:
         print("\nStopping capture.")
+    save_queue.join()
     print("Done.")
 
 
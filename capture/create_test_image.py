@@ -1,18 +1,30 @@
 """Generate a simple test chalkboard image for demo/testing purposes."""
 
-import cv2
-import numpy as np
 
-# Create a dark green "chalkboard" background
-img = np.full((480, 640, 3), (50, 80, 50), dtype=np.uint8)
+def main():
+    # Imported here so importing this module doesn't load Pillow
+    from PIL import Image, ImageDraw, ImageFont
 
-# Add some white "chalk" text
-cv2.putText(img, "Lecture 1: Intro to ML", (30, 80), cv2.FONT_HERSHEY_SIMPLEX, 1.0, (220, 220, 220), 2)
-cv2.putText(img, "- Supervised Learning", (50, 150), cv2.FONT_HERSHEY_SIMPLEX, 0.8, (200, 200, 200), 2)
-cv2.putText(img, "- Unsupervised Learning", (50, 200), cv2.FONT_HERSHEY_SIMPLEX, 0.8, (200, 200, 200), 2)
-cv2.putText(img, "- Reinforcement Learning", (50, 250), cv2.FONT_HERSHEY_SIMPLEX, 0.8, (200, 200, 200), 2)
-cv2.putText(img, "y = mx + b", (50, 340), cv2.FONT_HERSHEY_SIMPLEX, 1.2, (230, 230, 230), 2)
-cv2.putText(img, "Loss = sum(y - y_hat)^2", (50, 410), cv2.FONT_HERSHEY_SIMPLEX, 0.9, (210, 210, 210), 2)
+    # Create a dark green "chalkboard" background
+    img = Image.new("RGB", (640, 480), (50, 80, 50))
+    draw = ImageDraw.Draw(img)
 
-cv2.imwrite("test_chalkboard.jpg", img)
-print("Created test_chalkboard.jpg")
+    # Add some white "chalk" text: (text, baseline origin, font size, gray level)
+    lines = [
+        ("Lecture 1: Intro to ML", (30, 80), 32, 220),
+        ("- Supervised Learning", (50, 150), 26, 200),
+        ("- Unsupervised Learning", (50, 200), 26, 200),
+        ("- Reinforcement Learning", (50, 250), 26, 200),
+        ("y = mx + b", (50, 340), 38, 230),
+        ("Loss = sum(y - y_hat)^2", (50, 410), 29, 210),
+    ]
+    for text, origin, size, gray in lines:
+        font = ImageFont.load_default(size=size)
+        draw.text(origin, text, fill=(gray, gray, gray), font=font, anchor="ls")
+
+    img.save("test_chalkboard.jpg", quality=90)
+    print("Created test_chalkboard.jpg")
+
+
+if __name__ == "__main__":
+    main()
@@ -230,12 +230,10 @@ export default function ProfessorRoomPage() {
     setLastCapture(new Date().toLocaleTimeString());
 
     try {
-      const formData = new FormData();
-      formData.append("file", blob, `capture_${Date.now()}.jpg`);
-
-      await fetch(`${BACKEND_URL}/rooms/${code}/upload-image`, {
+      await fetch(`${BACKEND_URL}/rooms/${code}/upload-image-raw`, {
         method: "POST",
-        body: formData,
+        headers: { "Content-Type": blob.type },
+        body: blob,
       });
 
       setCaptureCount((c) => c + 1);
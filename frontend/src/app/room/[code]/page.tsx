@@ -109,6 +109,38 @@ export default function StudentRoomPage() {
     await fetchNotesForRoom(room.id);
   }, [room, fetchNotesForRoom]);
 
+  // Realtime deltas: merge the changed row instead of refetching everything
+  const mergeNoteRow = useCallback((row: Record<string, unknown>) => {
+    const sectionId = row.section_id as string;
+    const current = notesRef.current;
+    const index = current.findIndex((n) => n.section_id === sectionId);
+    const merged: NoteSection = {
+      section_id: sectionId,
+      type: row.type as NoteSection["type"],
+      content: row.content as string,
+      caption: row.caption as string | undefined,
+      image_url: row.image_url as string | undefined,
+      highlight_count: index >= 0 ? current[index].highlight_count : 0,
+    };
+    // New rows have the highest id, so appending keeps the id order
+    const next = index >= 0 ? current.map((n, i) => (i === index ? merged : n)) : [...current, merged];
+
+    if (index < 0 && prevNoteIdsRef.current.size > 0) {
+      setNewSectionIds((prev) => new Set([...prev, sectionId]));
+    }
+    setNotes(next);
+    notesRef.current = next;
+    prevNoteIdsRef.current = new Set(next.map((n) => n.section_id));
+  }, []);
+
+  const mergeHighlightRow = useCallback((row: Record<string, unknown>) => {
+    const next = notesRef.current.map((n) =>
+      n.section_id === row.section_id ? { ...n, highlight_count: (row.highlight_count as number) || 0 } : n
+    );
+    setNotes(next);
+    notesRef.current = next;
+  }, []);
+
   // Fetch room info + notes in parallel, then subscribe to realtime
   useEffect(() => {
     let cancelled = false;
@@ -160,13 +192,20 @@ export default function StudentRoomPage() {
           table: "lecture_notes",
           filter: `room_id=eq.${room.id}`,
         },
-        () => {
-          fetchNotes().then(() => {
-            // Scroll to bottom when new content arrives
+        (payload) => {
+          // Scroll to bottom when new content arrives
+          const scrollToBottom = () => {
             setTimeout(() => {
               bottomRef.current?.scrollIntoView({ behavior: "smooth" });
             }, 200);
-          });
+          };
+          // DELETE payloads only carry the primary key; refetch for those
+          if (payload.eventType === "DELETE") {
+            fetchNotes().then(scrollToBottom);
+          } else {
+            mergeNoteRow(payload.new as Record<string, unknown>);
+            scrollToBottom();
+          }
         }
       )
       .on(
@@ -177,7 +216,10 @@ export default function StudentRoomPage() {
           table: "highlights",
           filter: `room_id=eq.${room.id}`,
         },
-        () => fetchNotes()
+        (payload) => {
+          if (payload.eventType === "DELETE") fetchNotes();
+          else mergeHighlightRow(payload.new as Record<string, unknown>);
+        }
       )
       .on(
         "postgres_changes",
@@ -187,7 +229,14 @@ export default function StudentRoomPage() {
           table: "comments",
           filter: `room_id=eq.${room.id}`,
         },
-        () => fetchNotes()
+        (payload) => {
+          if (payload.eventType !== "INSERT") {
+            fetchNotes();
+            return;
+          }
+          const comment = payload.new as Comment;
+          setComments((prev) => (prev.some((c) => c.id === comment.id) ? prev : [...prev, comment]));
+        }
       )
       .subscribe();
 
@@ -206,7 +255,7 @@ export default function StudentRoomPage() {
       presenceChannel.untrack();
       sb.removeChannel(presenceChannel);
     };
-  }, [room, fetchNotes]);
+  }, [room, fetchNotes, mergeNoteRow, mergeHighlightRow]);
 
   // Listen for text selection inside the notes article
   useEffect(() => {
@@ -288,10 +337,10 @@ export default function StudentRoomPage() {
         }),
       });
 
+      // The new count and comment arrive through the realtime subscription
       setCommentText("");
       setSelection(null);
       window.getSelection()?.removeAllRanges();
-      fetchNotes();
     } finally {
       setSending(false);
       setFlagging(false);